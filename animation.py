@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf-8
+# animation.py
+import os
+
+import numpy as np
+import datashader
+
+PLAY_FPS = int(os.environ.get('COAWST_PLAY_FPS', 4))
+LEVELS = 255 # uint8 codes for values; the last code marks missing cells
+MISSING = LEVELS
+
+
+def quantize(values, clim):
+    # uint8 codes 0..254 spread linearly over clim; the error is at most
+    # half a step, (clim[1]-clim[0])/508
+    lo, hi = clim
+    scale = (LEVELS-1)/(hi-lo) if hi > lo else 0
+    codes = np.clip(np.rint((values-lo)*scale), 0, LEVELS-1)
+    return np.where(np.isfinite(values), codes, MISSING).astype('u1')
+
+
+def dequantize(codes, clim):
+    lo, hi = clim
+    values = lo + codes.astype('f4')*((hi-lo)/(LEVELS-1))
+    values[codes == MISSING] = np.nan
+    return values
+
+
+class FrameBuffer:
+    # Every time step of one field rasterized over a fixed viewport and
+    # stored as uint8 codes against colour limits shared by all frames, so
+    # 72 frames of an 800x600 view take about 35 MB
+    def __init__(self, frames, x_range, y_range, clim):
+        self.frames = frames
+        self.x_range = x_range
+        self.y_range = y_range
+        self.clim = clim
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def __len__(self):
+        return len(self.frames)
+
+    def frame(self, i):
+        return dequantize(self.frames[i], self.clim)
+
+    @classmethod
+    def from_stack(cls, stack, x_range, y_range, width, height):
+        # `stack` is a computed (ocean_time, eta_rho, xi_rho) field with
+        # x_rho/y_rho coordinates
+        x = stack.x_rho.values
+        y = stack.y_rho.values
+        x_range = tuple(x_range or (np.nanmin(x), np.nanmax(x)))
+        y_range = tuple(y_range or (np.nanmin(y), np.nanmax(y)))
+        canvas = datashader.Canvas(
+            plot_width=int(width), plot_height=int(height),
+            x_range=x_range, y_range=y_range,
+        )
+        rasters = np.stack([
+            canvas.quadmesh(stack.isel(ocean_time=i), x='x_rho', y='y_rho').values
+            for i in range(stack.sizes['ocean_time'])
+        ])
+        if np.isfinite(rasters).any():
+            clim = (float(np.nanmin(rasters)), float(np.nanmax(rasters)))
+        else:
+            clim = (0.0, 1.0)
+        return cls(quantize(rasters, clim), x_range, y_range, clim)
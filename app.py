@@ -1,21 +1,23 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
 import datetime
+from functools import partial
 
+import dask
 import param
 import asyncio
-import intake
 import panel as pn
 import numpy as np
 import xarray as xr
-import xroms
 import hvplot.xarray
 import geoviews as gv
 import geoviews.tile_sources as gts
 import cartopy.crs as ccrs
 import holoviews as hv
-from holoviews.streams import DoubleTap
+from holoviews.operation.datashader import rasterize
+from holoviews.streams import DoubleTap, PlotSize, RangeXY
 from bokeh.themes import Theme
 from bokeh.models.formatters import PrintfTickFormatter
 from concurrent.futures import ThreadPoolExecutor
@@ -24,9 +26,38 @@ from asyncio import wrap_future
 
 from dask.distributed import Client
 from cluster import DASK_SCHEDULER_ADDRESS
+from animation import PLAY_FPS, FrameBuffer
+from cache import RenderCache
+from codec import decode, decode_dataset
+from contours import CONTOUR_LEVELS, ContourSet
+from metrics import register_stats, slow_report, span, timed
+from projection import REGRID, Regridder
+from pyramid import choose_factor, coarsen_masked, summarize, viewport_clim
+from scheduler import COALESCE_DELAY, PREFETCH_HOURS, Prefetcher, RenderScheduler
+from spatial import ArrowSampler, RhoIndex
+from ingest import STORE_PATH
+from store import REFRESH_INTERVAL, SHARE_DATASET, FieldSource, refresh_store, shared_store
+from tiles import TILE_CMAPS, TILE_LAYERS, tile_url
+from vertical import SIGMA_DEPTHS, depth_choices, select_depth, sigma_index, z_depth
 
 
 
+PANEL_FIELDS = ['salt','evaporation','Hwave','Dwave','mag','angle','temp','zeta']
+PLAY_FIELDS = {
+    'Temperature': 'temp',
+    'Salinity': 'salt',
+    'Wave Height': 'Hwave',
+    'Current Speed': 'mag',
+}
+TIMESERIES = {
+    # variable: (search radius [km], title)
+    'salt': (9, 'Salinity'),
+    'Hwave': (7, 'Wave Height m'),
+    'mag': (7, 'Current Speed m/s'),
+    'temp': (7, 'Temperature C'),
+    'zeta': (7, 'Sea Level m'),
+}
+
 hv.renderer('bokeh').webgl = True
 pn.extension(
     throttled=True,
@@ -38,7 +69,7 @@ pn.extension(
 )
 pn.param.ParamMethod.loading_indicator = True
 
-# executor = ThreadPoolExecutor(max_workers=4)
+executor = ThreadPoolExecutor(max_workers=4)
 # THEME_JSON = {
 #     "attrs": {
 #         "figure": {
@@ -115,7 +146,7 @@ class COAWST_Viewer(pn.viewable.Viewer):
     depth = param.Selector(
         default="Surface", 
         # label="Network (delete & type to search)"
-        objects=["Surface","Middle","Bottom"]
+        objects=SIGMA_DEPTHS
     )
     def __init__(self, **params):
         super().__init__(**params)
@@ -183,10 +214,10 @@ class COAWST_Viewer(pn.viewable.Viewer):
             format=PrintfTickFormatter(format='+%d hours'),
             sizing_mode='stretch_width',
         )
-        depth_select = pn.widgets.Select.from_param(
+        self._depth_select = pn.widgets.Select.from_param(
             self.param.depth,
             name='Depth',
-            options=['Surface', 'Middle', 'Bottom'],
+            options=SIGMA_DEPTHS,
             sizing_mode="stretch_width",
         )
         self._salt_pane = pn.pane.HoloViews(
@@ -216,11 +247,42 @@ class COAWST_Viewer(pn.viewable.Viewer):
             self._sea_level_pane,
             sizing_mode="scale_both",
         )
+        self._play_field = pn.widgets.Select(
+            name='Animate',
+            options=PLAY_FIELDS,
+            sizing_mode='stretch_width',
+        )
+        self._play_fps = pn.widgets.IntSlider(
+            name='Frames per second',
+            start=1, end=12, value=PLAY_FPS,
+            sizing_mode='stretch_width',
+        )
+        self._player = pn.widgets.Player(
+            start=self.param.time.bounds[0],
+            end=self.param.time.bounds[1],
+            interval=1000//PLAY_FPS,
+            loop_policy='loop',
+            show_value=False,
+            visible_buttons=['pause', 'play'],
+            sizing_mode='stretch_width',
+        )
+        self._play_toggle = pn.widgets.Toggle(
+            name='Play forecast',
+            button_type='success',
+            sizing_mode='stretch_width',
+        )
+        self._play_fps.param.watch(self._set_play_fps, 'value')
+        self._play_toggle.param.watch(self._toggle_play, 'value')
+        self._player.param.watch(self._play_step, 'value')
         self._sidebar.objects = [
             # pn.pane.Markdown(WELCOME_MESSAGE),
             open_button,
             time_select,
-            depth_select,
+            self._depth_select,
+            self._play_field,
+            self._play_fps,
+            self._play_toggle,
+            self._player,
             self._timeseries,
             # pn.pane.Markdown(FOOTER_MESSAGE),
         ]
@@ -228,8 +290,20 @@ class COAWST_Viewer(pn.viewable.Viewer):
     def _populate_main(self):
         pn.state.notifications.info('Application initialized. Loading data...', duration=5000)
         self._main.loading=True
-        self._roms_ds = self._get_roms_ds()
-        self._time_stamps = self._roms_ds.ocean_time.values.astype(str)
+        self._render_cache = pn.state.as_cached('render_cache', self._load_render_cache)
+        self._scheduler = RenderScheduler(self._get_client())
+        self._use_store(self._get_store())
+        # a local mirror is rolled forward by ingest.py; follow its cycles
+        if REFRESH_INTERVAL and os.path.exists(STORE_PATH):
+            pn.state.schedule_task(
+                'coawst_refresh', refresh_store,
+                period=datetime.timedelta(seconds=REFRESH_INTERVAL), threaded=True,
+            )
+        self._prefetcher = pn.state.as_cached('prefetcher', self._load_prefetcher)
+        self._rho_index = pn.state.as_cached('rho_index', self._load_rho_index)
+        self._arrow_sampler = pn.state.as_cached('arrow_sampler', self._load_arrow_sampler)
+        x = self._roms_ds.x_rho
+        self._cell_size = float(x.max()-x.min())/self._roms_ds.sizes['xi_rho']
         self._tile = pn.state.as_cached('tile', self._load_tile)
         self._tile_proj = pn.state.as_cached('tile_proj', self._load_tile_proj)
         self._plot_proj = pn.state.as_cached('plot_proj', self._load_plot_proj)
@@ -241,12 +315,28 @@ class COAWST_Viewer(pn.viewable.Viewer):
             max_height=100,
         )
         self._main_title.objects = [self._markdown_title]
-        self._salt_pane.object = pn.bind(self._update_salt_timeseries, self._dtap.param.x, self._dtap.param.y, self.param.time, self.param.depth) 
-        self._wave_pane.object = pn.bind(self._update_wave_timeseries, self._dtap.param.x, self._dtap.param.y, self.param.time) 
-        self._current_pane.object = pn.bind(self._update_current_timeseries, self._dtap.param.x, self._dtap.param.y, self.param.time, self.param.depth) 
-        self._temperature_pane.object = pn.bind(self._update_temperature_timeseries, self._dtap.param.x, self._dtap.param.y, self.param.time, self.param.depth) 
-        self._sea_level_pane.object = pn.bind(self._update_sea_level_timeseries, self._dtap.param.x, self._dtap.param.y, self.param.time) 
-        self._main.objects = pn.bind(self._update_plots, self.param.time, self.param.depth)
+        self._salt_pane.object = pn.bind(self._update_timeseries, 'salt', self._dtap.param.x, self._dtap.param.y, self.param.depth)
+        self._wave_pane.object = pn.bind(self._update_timeseries, 'Hwave', self._dtap.param.x, self._dtap.param.y, self.param.depth)
+        self._current_pane.object = pn.bind(self._update_timeseries, 'mag', self._dtap.param.x, self._dtap.param.y, self.param.depth)
+        self._temperature_pane.object = pn.bind(self._update_timeseries, 'temp', self._dtap.param.x, self._dtap.param.y, self.param.depth)
+        self._sea_level_pane.object = pn.bind(self._update_timeseries, 'zeta', self._dtap.param.x, self._dtap.param.y, self.param.depth)
+        self._salt_map = pn.pane.HoloViews(sizing_mode='stretch_both')
+        self._wave_map = pn.pane.HoloViews(sizing_mode='stretch_both')
+        self._current_map = pn.pane.HoloViews(sizing_mode='stretch_both')
+        self._temperature_map = pn.pane.HoloViews(sizing_mode='stretch_both')
+        self._field_maps = {
+            'salt': self._salt_map,
+            'Hwave': self._wave_map,
+            'mag': self._current_map,
+            'temp': self._temperature_map,
+        }
+        self._viewports = {}
+        self._main.objects = [
+            pn.Row(self._salt_map, self._wave_map, sizing_mode='scale_both'),
+            pn.Row(self._current_map, self._temperature_map, sizing_mode='scale_both'),
+        ]
+        pn.bind(self._update_plots, self.param.time, self.param.depth, watch=True)
+        pn.state.execute(partial(self._update_plots, self.time, self.depth))
 
     def _populate_modal(self):
         with open('./README_modal.md') as f:
@@ -257,18 +347,25 @@ class COAWST_Viewer(pn.viewable.Viewer):
     def _open_modal(self, event):
         self._template.open_modal()
         
-    @pn.cache
-    def _get_roms_ds(self):
-        intake_catalog_url = 'https://usgs-coawst.s3.amazonaws.com/useast-archive/coawst_intake.yml'
-        cat = intake.open_catalog(intake_catalog_url)
-        ds = cat['COAWST-USEAST'].to_dask()
-        ds=ds[
-            ['temp','zeta','u','v','Hwave','Dwave','salt','evaporation']
-        ].isel(
-            s_rho=[0,7,15],
-            ocean_time=slice(-72,None)
-        )
-        return ds
+    def _get_store(self):
+        return shared_store()
+
+    def _use_store(self, store):
+        # Everything a session reads from the served store, replaced together
+        # when the refresher swaps in a new forecast cycle
+        if SHARE_DATASET:
+            store.share(self._get_client())
+        self._store = store
+        self._roms_ds = store.map
+        self._time_stamps = self._roms_ds.ocean_time.values.astype(str)
+        self._version = store.version
+        self._render_cache.set_version(self._version)
+        self._source = FieldSource(store, self._render_cache, self._scheduler.compute)
+        self._player.end = len(self._time_stamps)-1
+        # metre depths are offered when the store has its vertical grid
+        depths = depth_choices(self._roms_ds)
+        self.param.depth.objects = depths
+        self._depth_select.options = depths
 
     def _load_tile(*args, **kwargs):
         return gts.EsriImagery()
@@ -278,32 +375,215 @@ class COAWST_Viewer(pn.viewable.Viewer):
 
     def _load_plot_proj(*args, **kwargs):
         return ccrs.PlateCarree()
-    
-    @pn.cache(per_session=True)
+
+    def _load_render_cache(self, *args, **kwargs):
+        return register_stats('render_cache', RenderCache())
+
+    def _load_prefetcher(self, *args, **kwargs):
+        client = Client(DASK_SCHEDULER_ADDRESS, set_as_default=False)
+        return register_stats('prefetcher', Prefetcher(self._render_cache, client))
+
+    def _load_rho_index(self, *args, **kwargs):
+        ds = self._roms_ds
+        mask = ds.mask_rho.values if 'mask_rho' in ds.coords else None
+        return RhoIndex(ds.lon_rho.values, ds.lat_rho.values, mask)
+
+    def _load_arrow_sampler(self, *args, **kwargs):
+        ds = self._roms_ds
+        mask = ds.mask_rho.values if 'mask_rho' in ds.coords else None
+        return ArrowSampler(ds.x_rho.values, ds.y_rho.values, mask)
+
+    def _tap_cells(self, lon, lat, radius):
+        eta, xi = self._rho_index.query(lon, lat, radius=radius)
+        if not len(eta):
+            return None
+        return dict(
+            eta_rho=xr.DataArray(eta, dims='cell'),
+            xi_rho=xr.DataArray(xi, dims='cell'),
+        )
+
+    @pn.cache(max_items=16)
+    def _extract_timeseries(self, x, y, depth, version):
+        # Every sidebar series for one tapped point, gathered in one compute.
+        # `version` only keys the cache to the forecast cycle, so only misses
+        # are timed here.
+        lon,lat = self._plot_proj.transform_point(x, y,self._tile_proj)
+        series = {}
+        if not ((lon>=-100) and (lon<=-76) and (lat>=18) and (lat<=31)):
+            return lon, lat, series
+        with span('timeseries', '+'.join(TIMESERIES), depth, cache='miss'):
+            for var, (radius, _) in TIMESERIES.items():
+                cells = self._tap_cells(lon, lat, radius)
+                if cells is None:
+                    continue
+                da = decode(self._store.series[var]).isel(**cells)
+                weights = None
+                if self._source.z_slice(var, depth):
+                    zeta = decode(self._store.series['zeta']).isel(**cells)
+                    weights = self._source.vertical.weights(zeta, z_depth(depth), cells)
+                series[var] = select_depth(da, depth, weights).mean(dim='cell',skipna=True)
+            series = dict(zip(series, dask.compute(*series.values())))
+        return lon, lat, series
+
+    def _update_timeseries(self, var, x, y, depth):
+        # a tap may come long after the last render, from an older cycle
+        if self._get_store() is not self._store:
+            self._use_store(self._get_store())
+        lon, lat, series = self._extract_timeseries(x, y, depth, self._version)
+        if var in series:
+            with span('timeseries_plot', var, depth):
+                plot = series[var].hvplot(
+                        kind='line',
+                        x='ocean_time',
+                        title=f'{TIMESERIES[var][1]} ({lon:.4}, {lat:.4})',
+                    ).opts(labelled=[],active_tools=[],max_height=200,width=250,yaxis=None)
+                plot *= hv.DynamicMap(pn.bind(self._update_time_marker, self.param.time))
+            return plot
+
+    def _update_time_marker(self, time):
+        return hv.VLine(self._roms_ds.ocean_time.values[int(time)]).opts(color='r')
+
+    def _get_summary(self, name, time, depth, factor):
+        key = self._source.key(name, time, depth, 'summary', factor)
+        return self._source.cached('summary', key, partial(self._load_summary, name, time, depth, factor))
+
+    def _load_summary(self, name, time, depth, factor):
+        summary = self._store.summary.get(factor)
+        if summary is not None and f'{name}_min' in summary and not self._source.z_slice(name, depth):
+            names = [f'{name}_min', f'{name}_max', f'{name}_nan']
+            summary = summary[names].isel(ocean_time=int(time))
+            if 's_rho' in summary.dims:
+                summary = summary.isel(s_rho=sigma_index(summary, depth))
+            return summary
+        field = decode(self._source.level(name, time, depth, factor))
+        return summarize(field.to_dataset(name=name), [name])
+
+    def _pyramid_factor(self, x_range, width):
+        if x_range is None:
+            n_cells = self._roms_ds.sizes['xi_rho']
+        else:
+            n_cells = abs(x_range[1]-x_range[0])/self._cell_size
+        return choose_factor(n_cells, width or 800)
+
+    def _regridder(self, field, factor):
+        # Regridding weights depend only on the grid, so they are built once
+        # per pyramid level and shared by every session
+        regridders = pn.state.as_cached('regridders', dict)
+        if factor not in regridders:
+            regridders[factor] = Regridder(field.x_rho.values, field.y_rho.values)
+        return regridders[factor]
+
+    def _quadmesh(self, name, time, depth, **opts):
+        # Rasterized quadmesh drawn from the coarsest pyramid level that
+        # still resolves the current viewport, with colour limits taken from
+        # the tile summaries of that level rather than a scan of the field.
+        # With TILE_LAYERS the layer comes from the tile endpoint instead,
+        # which browsers and proxies can cache.
+        if TILE_LAYERS:
+            return gv.WMTS(tile_url(name, time, depth, self._version)).opts(responsive=True)
+        def level(x_range=None, y_range=None, width=None, height=None, **kwargs):
+            self._viewports[name] = (x_range, y_range, width, height)
+            factor = self._pyramid_factor(x_range, width)
+            field = decode(self._source.level(name, time, depth, factor))
+            if REGRID:
+                regrid = self._regridder(field, factor)
+                element = hv.Image((regrid.xs, regrid.ys, regrid(field.values)), kdims=['x_rho','y_rho'], vdims=[name])
+            else:
+                element = hv.QuadMesh(field, kdims=['x_rho','y_rho'], vdims=[name])
+            clim = viewport_clim(self._get_summary(name, time, depth, factor), name, x_range, y_range)
+            return element if clim is None else element.redim.range(**{name: clim})
+        dmap = hv.DynamicMap(level, streams=[RangeXY(), PlotSize()])
+        _, _, level_depth, _ = self._source.key(name, time, depth)
+        return timed(rasterize, 'rasterize', name, level_depth)(dmap).opts(
+            colorbar=True,
+            framewise=True,
+            responsive=True,
+            tools=['hover'],
+            **opts
+        )
+
+    def _get_contours(self, name, time, depth, levels):
+        key = self._source.key(name, time, depth, 'contours', levels)
+        return self._source.cached('contours', key, partial(self._load_contours, name, time, depth, levels))
+
+    def _load_contours(self, name, time, depth, levels):
+        field = decode(self._source.fields([name], time, depth)[name])
+        return ContourSet(field.x_rho.values, field.y_rho.values, field.values, levels)
+
+    def _contours(self, name, time, depth, levels=CONTOUR_LEVELS, **opts):
+        # Cached contour lines, simplified for the zoom level and clipped to
+        # the viewport so the vertices sent to Bokeh stay bounded
+        def lines(x_range=None, y_range=None, **kwargs):
+            contours = self._get_contours(name, time, depth, levels)
+            return hv.Contours(contours.paths(x_range, y_range), vdims=['level'])
+        return hv.DynamicMap(lines, streams=[RangeXY()]).opts(color='level', **opts)
+
+    def _get_arrows(self, mag, angle, time, depth, zoom):
+        key = self._source.key(mag, time, depth, 'arrows', angle, zoom)
+        return self._source.cached('arrows', key, partial(self._load_arrows, mag, angle, time, depth, zoom))
+
+    def _load_arrows(self, mag, angle, time, depth, zoom):
+        # x, y, angle, magnitude of the arrows picked for one zoom level
+        ds = decode_dataset(self._source.fields([mag, angle], time, depth))
+        eta, xi = self._arrow_sampler.sample(zoom)
+        # VectorField angles are radians; Dwave is stored in degrees while
+        # the current `angle` is derived in radians
+        direction = ds[angle].values[eta, xi]
+        if angle == 'Dwave':
+            direction = np.deg2rad(direction)
+        return np.column_stack([
+            ds.x_rho.values[eta, xi],
+            ds.y_rho.values[eta, xi],
+            direction,
+            ds[mag].values[eta, xi],
+        ])
+
+    def _vectors(self, mag, angle, time, depth, **opts):
+        # Arrows picked on a lattice matched to the zoom level, so about the
+        # same number are drawn across the viewport at any zoom
+        def arrows(x_range=None, y_range=None, **kwargs):
+            data = self._get_arrows(mag, angle, time, depth, self._arrow_sampler.zoom(x_range))
+            if x_range is not None and y_range is not None:
+                data = data[
+                    (data[:,0] >= x_range[0]) & (data[:,0] <= x_range[1]) &
+                    (data[:,1] >= y_range[0]) & (data[:,1] <= y_range[1])
+                ]
+            return hv.VectorField(data, kdims=['x_rho','y_rho'], vdims=[angle, mag])
+        return hv.DynamicMap(arrows, streams=[RangeXY()]).opts(magnitude=mag, **opts)
+
+    def _neighbour_fields(self, time, depth):
+        # The views a user is most likely to pick next: the nearest lead
+        # times at this depth first, then the other levels at this time
+        time = int(time)
+        views = [
+            (t, depth)
+            for step in range(1, PREFETCH_HOURS+1)
+            for t in (time+step, time-step)
+            if 0 <= t < len(self._time_stamps)
+        ]
+        views += [(time, other) for other in SIGMA_DEPTHS if other != depth]
+        fields = {}
+        for t, d in views:
+            for name in PANEL_FIELDS:
+                key = self._source.key(name, t, d)
+                if self._source.z_slice(name, d) and ('z_weights', t, d, self._version) not in self._render_cache:
+                    # the weights would need this step's zeta read first
+                    continue
+                if key not in fields and key not in self._render_cache:
+                    fields[key] = self._source.select(name, t, d)
+        return fields
+
     def _update_salt_plot(self, time, depth):
-        match depth:
-            case "Surface":
-                depth = -1
-            case "Middle":
-                depth = -2
-            case "Bottom":
-                depth = -3
-        ds = self._roms_ds.isel(ocean_time=int(time), s_rho=depth)[['salt','evaporation']].persist()
         plot = hv.Overlay([])
         plot *= self._tile
-        plot *= ds.salt.hvplot.quadmesh(
-            x='lon_rho',y='lat_rho',
-            rasterize=True,
-            crs=self._plot_proj,
+        plot *= self._quadmesh(
+            'salt', time, depth,
             cmap='pink_r',
-            responsive=True,
-            clabel='Salinity'
+            clabel='Salinity',
         ).opts(alpha=0.75)
-        plot *= ds.evaporation.hvplot.contour(
-            x='lon_rho',y='lat_rho',
-            crs=self._plot_proj,
-            rasterize=True,
-            hover=False,
+        plot *= self._contours(
+            'evaporation', time, depth,
+            colorbar=True,
             responsive=True,
         )
 
@@ -317,201 +597,51 @@ class COAWST_Viewer(pn.viewable.Viewer):
             # xlim=(min_x, df[self.var].max()),
         )
 
-    def _update_salt_timeseries(self,x,y,time,depth):
-        roms_spacing=9 #km
-        match depth:
-            case "Surface":
-                depth = -1
-            case "Middle":
-                depth = -2
-            case "Bottom":
-                depth = -3
-        lon,lat = self._plot_proj.transform_point(x, y,self._tile_proj)
-        if ((lon>=-100) and (lon<=-76) and (lat>=18) and (lat<=31)):
-            ds = self._roms_ds.isel(s_rho=depth)
-            da = ds.where(
-                    (ds.lon_rho>=lon-roms_spacing/111) &\
-                    (ds.lon_rho<=lon+roms_spacing/111) &\
-                    (ds.lat_rho>=lat-roms_spacing/111) &\
-                    (ds.lat_rho<=lat+roms_spacing/111)
-                ).salt.persist()
-            plot = da.mean(dim=['eta_rho','xi_rho'],skipna=True).hvplot(
-                    kind='line',
-                    x='ocean_time',
-                    title=f'Salinity ({lon:.4}, {lat:.4})',
-                ).opts(labelled=[],active_tools=[],max_height=200,width=250,yaxis=None)
-            plot *= hv.VLine(da.ocean_time.values[int(time)]).opts(color='r')
-            return plot
-
-    @pn.cache(per_session=True)
     def _update_wave_plot(self, time):
-        ds = self._roms_ds.isel(
-            ocean_time=int(time),
-            s_rho=-1
-        )[["Hwave","Dwave"]].persist()
         plot = hv.Overlay([])
         plot *= self._tile
-        plot *= ds.Hwave.hvplot.quadmesh(
-            x='lon_rho',y='lat_rho',
+        plot *= self._quadmesh(
+            'Hwave', time, "Surface",
             cmap='cool',
-            rasterize=True,
-            crs=self._plot_proj,
-            responsive=True,
-            clabel='Height [m]'
+            clabel='Height [m]',
         )
-        plot *= ds.sel(
-            eta_rho=slice(None,None,25),
-            xi_rho=slice(None,None,25)
-        ).hvplot.vectorfield(
-            x='lon_rho',y='lat_rho',
-            mag='Hwave',angle='Dwave',
-            rasterize=True,hover=False,
-            crs=self._plot_proj,
-            responsive=True,
-        ).opts(magnitude='Hwave',)
+        plot *= self._vectors('Hwave', 'Dwave', time, "Surface")
 
         return plot.opts(
             title='Significant Wave Height',
         )
 
-    def _update_wave_timeseries(self,x,y,time):
-        roms_spacing=7 #km
-        lon,lat = self._plot_proj.transform_point(x, y,self._tile_proj)
-        if ((lon>=-100) and (lon<=-76) and (lat>=18) and (lat<=31)):
-            ds = self._roms_ds
-            da = ds.where(
-                    (ds.lon_rho>=lon-roms_spacing/111) &\
-                    (ds.lon_rho<=lon+roms_spacing/111) &\
-                    (ds.lat_rho>=lat-roms_spacing/111) &\
-                    (ds.lat_rho<=lat+roms_spacing/111)
-                ).Hwave.persist()
-            plot= da.mean(dim=['eta_rho','xi_rho'],skipna=True).hvplot(
-                    kind='line',
-                    x='ocean_time',
-                    title=f'Wave Height m ({lon:.4}, {lat:.4})',
-                ).opts(labelled=[],active_tools=[],max_height=200,width=250,yaxis=None)
-            plot *= hv.VLine(da.ocean_time.values[int(time)]).opts(color='r')
-            return plot
-
-    def _u_to_rho(self,ds,):
-        Mp,L=np.shape(ds.u)
-        Lp=L+1
-        Lm=L-1
-        values = 0.5*(ds.u[...,:Lm]+ds.u[...,1:])
-        ds["u_rho"]=xr.zeros_like(ds.temp)
-        ds["u_rho"][...,1:L]=values.data
-        ds["u_rho"][...,0]=ds["u_rho"][...,1]
-        ds["u_rho"][...,-1]=ds["u_rho"][...,-2]
-        return ds
-        
-    def _v_to_rho(self,ds):
-        M,Lp=np.shape(ds.v)
-        Mp=M+1
-        Mm=M-1
-        values = 0.5*(ds.v[...,:Mm,:]+ds.v[...,1:,:])
-        ds["v_rho"]=xr.zeros_like(ds.temp)
-        ds["v_rho"][...,1:M,:]=values.data
-        ds["v_rho"][...,0,:]=ds["v_rho"][...,1,:]
-        ds["v_rho"][...,-1,:]=ds["v_rho"][...,-2,:]
-        return ds
-
-    @pn.cache(per_session=True)
     def _update_current_plot(self, time, depth):
-        match depth:
-            case "Surface":
-                depth = -1
-            case "Middle":
-                depth = -2
-            case "Bottom":
-                depth = -3
-        ds = self._roms_ds.isel(ocean_time=int(time), s_rho=depth)
-        ds = self._u_to_rho(ds)
-        ds = self._v_to_rho(ds)
-        ds["mag"] = np.hypot(ds.u_rho,ds.v_rho)
-        ds["angle"] = 3*np.pi/2 - np.arctan2(ds.v_rho, ds.u_rho)
-        ds = ds[["mag","angle"]].persist()
         plot = hv.Overlay([])
         plot *= gts.EsriImagery()
-        plot *= ds.mag.hvplot.quadmesh(
-            x='lon_rho',y='lat_rho',
-            rasterize=True,
-            crs=self._plot_proj,
+        plot *= self._quadmesh(
+            'mag', time, depth,
             cmap='cet_linear_wcmr_100_45_c42',
-            responsive=True,
-            clabel='Current Speed [m/s]'
+            clabel='Current Speed [m/s]',
         )
-        plot *= ds.sel(
-                eta_rho=slice(None,None,25),
-                xi_rho=slice(None,None,25)
-            ).hvplot.vectorfield(
-                x='lon_rho',y='lat_rho',
-                mag='mag',angle='angle',
-                crs=self._plot_proj,
-                rasterize=True,hover=False,
-                responsive=True,
-        ).opts(magnitude='mag')
-        plot *= ds.mag.hvplot.contour(
-            x="lon_rho",y="lat_rho",
-            levels=[0.75],
-            crs=self._plot_proj,
+        plot *= self._vectors('mag', 'angle', time, depth)
+        plot *= self._contours(
+            'mag', time, depth,
+            levels=(0.75,),
             cmap=['#000000'],
             line_width=2,
-            hover=False,
         )
 
         return plot.opts(
             title='Current Speed',
         )
 
-    def _update_current_timeseries(self,x,y,time,depth):
-        roms_spacing=7 #km
-        match depth:
-            case "Surface":
-                depth_idx = -1
-            case "Middle":
-                depth_idx = -2
-            case "Bottom":
-                depth_idx = -3
-        lon,lat = self._plot_proj.transform_point(x, y,self._tile_proj)
-        if ((lon>=-100) and (lon<=-76) and (lat>=18) and (lat<=31)):
-            ds = self._roms_ds.isel(s_rho=depth_idx)
-            da = ds.where(
-                    (ds.lon_rho>=lon-roms_spacing/111) &\
-                    (ds.lon_rho<=lon+roms_spacing/111) &\
-                    (ds.lat_rho>=lat-roms_spacing/111) &\
-                    (ds.lat_rho<=lat+roms_spacing/111) 
-                ).mag.persist()
-            plot = da.mean(dim=['eta_rho','xi_rho'],skipna=True).hvplot(
-                    kind='line',
-                    x='ocean_time',
-                    title=f'Current Speed m/s ({lon:.4}, {lat:.4})',
-                ).opts(labelled=[],active_tools=[],max_height=200,width=250,yaxis=None)
-            plot *= hv.VLine(da.ocean_time.values[int(time)]).opts(color='r')
-            return plot
     
-    @pn.cache(per_session=True)
     def _update_temperature_plot(self, time, depth):
-        match depth:
-            case "Surface":
-                depth = -1
-            case "Middle":
-                depth = -2
-            case "Bottom":
-                depth = -3
-        ds = self._roms_ds.isel(ocean_time=int(time), s_rho=depth)[["temp","zeta"]].persist()
         plot = hv.Overlay([])
         plot *= gts.EsriImagery()
-        plot *= ds.temp.hvplot.quadmesh(
-            x='lon_rho',y='lat_rho',
+        plot *= self._quadmesh(
+            'temp', time, depth,
             cmap='Plasma',
-            rasterize=True,
-            crs=self._plot_proj,
-            responsive=True,
-            clabel='Temperature [deg C]'
+            clabel='Temperature [deg C]',
         )
-        plot *= ds.zeta.hvplot.contour(
-            x='lon_rho',y='lat_rho',
-            crs=self._plot_proj,
+        plot *= self._contours(
+            'zeta', time, depth,
             cmap=['#000000'],
             line_width=2,
             responsive=True,
@@ -521,74 +651,143 @@ class COAWST_Viewer(pn.viewable.Viewer):
             title='Temperature + Sea Level',
         )
 
-    def _update_temperature_timeseries(self,x,y,time,depth):
-        roms_spacing=7 #km
-        match depth:
-            case "Surface":
-                depth_idx = -1
-            case "Middle":
-                depth_idx = -2
-            case "Bottom":
-                depth_idx = -3
-        lon,lat = self._plot_proj.transform_point(x, y,self._tile_proj)
-        if ((lon>=-100) and (lon<=-76) and (lat>=18) and (lat<=31)):
-            ds = self._roms_ds.isel(s_rho=depth_idx)
-            da = ds.where(
-                    (ds.lon_rho>=lon-roms_spacing/111) &\
-                    (ds.lon_rho<=lon+roms_spacing/111) &\
-                    (ds.lat_rho>=lat-roms_spacing/111) &\
-                    (ds.lat_rho<=lat+roms_spacing/111)
-                ).temp.persist()
-            plot = da.mean(dim=['eta_rho','xi_rho'],skipna=True).hvplot(
-                    kind='line',
-                    x='ocean_time',
-                    title=f'Temperature C ({lon:.4}, {lat:.4})',
-                ).opts(labelled=[],active_tools=[],max_height=200,width=250,yaxis=None)
-            plot *= hv.VLine(da.ocean_time.values[int(time)]).opts(color='r')
-            return plot
+    def _get_frames(self, name, depth, x_range, y_range, width, height):
+        viewport = tuple(None if r is None else tuple(np.round(r).astype(int)) for r in (x_range, y_range))
+        key = self._source.key(name, None, depth, 'frames', *viewport, int(width), int(height))
+        return self._source.cached('frames', key, partial(self._load_frames, name, depth, x_range, y_range, width, height))
 
-    def _update_sea_level_timeseries(self,x,y,time):
-        roms_spacing=7 #km
-        lon,lat = self._plot_proj.transform_point(x, y,self._tile_proj)
-        if ((lon>=-100) and (lon<=-76) and (lat>=18) and (lat<=31)):
-            ds = self._roms_ds.isel(s_rho=depth_idx)
-            da = ds.where(
-                    (ds.lon_rho>=lon-roms_spacing/111) &\
-                    (ds.lon_rho<=lon+roms_spacing/111) &\
-                    (ds.lat_rho>=lat-roms_spacing/111) &\
-                    (ds.lat_rho<=lat+roms_spacing/111)
-                ).zeta.persist()
-            plot = da.mean(dim=['eta_rho','xi_rho'],skipna=True).hvplot(
-                    kind='line',
-                    x='ocean_time',
-                    title=f'Sea Level m ({lon:.4}, {lat:.4})',
-                ).opts(labelled=[],active_tools=[],max_height=200,width=250,yaxis=None)
-            plot *= hv.VLine(da.ocean_time.values[int(time)]).opts(color='r')
-            return plot
+    def _load_frames(self, name, depth, x_range, y_range, width, height):
+        # Every time step in one batched computation, read from the coarsest
+        # pyramid level that resolves the viewport
+        factor = self._pyramid_factor(x_range, width)
+        pyramid = self._store.pyramid
+        if factor in pyramid and name in pyramid[factor] and not self._source.z_slice(name, depth):
+            stack = select_depth(pyramid[factor][name], depth)
+        else:
+            weights = None
+            if self._source.z_slice(name, depth):
+                weights = self._source.vertical.weights(decode(self._roms_ds.zeta), z_depth(depth))
+            stack = coarsen_masked(decode(select_depth(self._roms_ds[name], depth, weights)), factor)
+        stack, = self._scheduler.compute(stack)
+        return FrameBuffer.from_stack(decode(stack), x_range, y_range, width, height)
 
-    def _update_plots(self,time,depth):
+    def _animation(self, name, frames):
+        # The buffered frames over the basemap, stepped by the player. Only
+        # the current frame is sent to the browser.
+        (x0, x1), (y0, y1) = frames.x_range, frames.y_range
+        ny, nx = frames.frames.shape[1:]
+        xs = x0+(np.arange(nx)+0.5)*(x1-x0)/nx
+        ys = y0+(np.arange(ny)+0.5)*(y1-y0)/ny
+        def frame(i):
+            return hv.Image((xs, ys, frames.frame(int(i))), kdims=['x_rho','y_rho'], vdims=[name])
+        plot = hv.Overlay([])
+        plot *= self._tile
+        plot *= hv.DynamicMap(pn.bind(frame, self._player.param.value)).opts(
+            cmap=TILE_CMAPS[name],
+            clim=frames.clim,
+            colorbar=True,
+            responsive=True,
+        )
+        title = next(label for label, field in PLAY_FIELDS.items() if field == name)
+        return plot.opts(xlim=(x0, x1), ylim=(y0, y1), title=title)
+
+    def _set_play_fps(self, event):
+        self._player.interval = 1000//event.new
+
+    def _play_step(self, event):
+        if self._play_toggle.value:
+            date = self._time_stamps[int(event.new)].split('T')
+            self._markdown_title.object = f"## {date[0]} {date[1].split('.')[0]} UTC"
+
+    def _stop_play(self):
+        self._player.pause()
+        with param.discard_events(self._play_toggle):
+            self._play_toggle.value = False
+
+    async def _toggle_play(self, event):
+        # Playing swaps the chosen panel for its frame buffer, built on first
+        # use for the panel's current viewport; stopping redraws the panels
+        if not event.new:
+            self._player.pause()
+            await self._update_plots(self.time, self.depth)
+            return
+        name = self._play_field.value
+        pane = self._field_maps[name]
+        x_range, y_range, width, height = self._viewports.get(name, (None, None, None, None))
+        pane.loading = True
+        try:
+            frames = await wrap_future(executor.submit(
+                self._scheduler.run, self._scheduler.generation, self._get_frames,
+                name, self.depth, x_range, y_range, width or 800, height or 600,
+            ))
+        finally:
+            pane.loading = False
+        if frames is None or not self._play_toggle.value:
+            return
+        pane.object = self._animation(name, frames)
+        self._player.value = int(self.time)
+        self._player.play()
+
+    async def _render_pane(self, generation, pane, names, time, depth, build):
+        # Compute a panel's fields on the executor, then build it and swap it
+        # in as soon as they are ready. The HoloViews objects themselves are
+        # built here on the event loop: DynamicMap.opts is not thread-safe.
+        pane.loading = True
+        try:
+            fields = await wrap_future(executor.submit(
+                self._scheduler.run, generation, self._source.fields, names, time, depth
+            ))
+            if fields is not None and self._scheduler.is_current(generation):
+                # building the overlay and rendering it to Bokeh models,
+                # which evaluates its DynamicMaps (and times them separately)
+                with span('render', names[0], depth):
+                    pane.object = build()
+        finally:
+            if self._scheduler.is_current(generation):
+                pane.loading = False
+
+    async def _update_plots(self,time,depth):
+        # Bursts of slider events collapse into the last one, and starting a
+        # new render cancels the dask work of the one it replaces
+        if self._play_toggle.value:
+            self._stop_play()
+        generation = self._scheduler.begin()
+        await asyncio.sleep(COALESCE_DELAY)
+        if not self._scheduler.is_current(generation):
+            return
+        if self._get_store() is not self._store:
+            self._use_store(self._get_store())
         pn.state.notifications.info('Making plots...', duration=10000)
         try:
-            if not self._sidebar.loading:
-                self._sidebar.loading = True
-            if not self._main.loading:
-                self._main.loading = True
-            date = self._time_stamps[int(self.time)].split('T')
+            self._main.loading = False
+            date = self._time_stamps[int(time)].split('T')
             self._markdown_title.object = f"## {date[0]} {date[1].split('.')[0]} UTC"
-            pn.state.notifications.info('Making salt plot...', duration=30000)
-            a=self._update_salt_plot(time,depth)
-            pn.state.notifications.info('Making wave plot...', duration=30000)
-            b=self._update_wave_plot(time)
-            pn.state.notifications.info('Making current plot...', duration=30000)
-            c=self._update_current_plot(time,depth)
-            pn.state.notifications.info('Making temperature plot...', duration=30000)
-            d=self._update_temperature_plot(time,depth)
-            pn.state.notifications.info('Rendering...', duration=30000)
-            return [pn.Row(a, b, sizing_mode='scale_both'),pn.Row(c,d, sizing_mode='scale_both')]
+            with self._prefetcher.user_render(), span('update', 'all', depth):
+                async with slow_report(f'render-t{int(time)}-{depth}'):
+                    await asyncio.gather(
+                        self._render_pane(
+                            generation, self._salt_map, ['salt','evaporation'], time, depth,
+                            partial(self._update_salt_plot, time, depth),
+                        ),
+                        self._render_pane(
+                            generation, self._wave_map, ['Hwave','Dwave'], time, depth,
+                            partial(self._update_wave_plot, time),
+                        ),
+                        self._render_pane(
+                            generation, self._current_map, ['mag','angle'], time, depth,
+                            partial(self._update_current_plot, time, depth),
+                        ),
+                        self._render_pane(
+                            generation, self._temperature_map, ['temp','zeta'], time, depth,
+                            partial(self._update_temperature_plot, time, depth),
+                        ),
+                    )
+            if self._scheduler.is_current(generation):
+                self._prefetcher.prefetch(self._neighbour_fields(time, depth))
         finally:
-            self._main.loading = False
-            self._sidebar.loading = False
-    
+            if self._scheduler.is_current(generation):
+                self._main.loading = False
+
     def __panel__(self):
         return self._template
 
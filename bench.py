@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+# bench.py
+import json
+import time
+import argparse
+import platform
+from functools import partial
+from unittest import mock
+
+import numpy as np
+import panel as pn
+import holoviews as hv
+from bokeh.embed import json_item
+from dask.distributed import Client, LocalCluster
+
+from cluster import DASK_SCHEDULER_ADDRESS, DASK_SCHEDULER_PORT
+from codec import decode_dataset
+from derived import add_current_fields
+from ingest import STORE_PATH, subset
+from store import ForecastStore, set_shared_store
+from synthetic import N_TIMES, USEAST_SHAPE, make_dataset
+
+TAP_CELLS = 3 # cells on a side read around a tapped point
+REPEAT = 3
+BENCH_WORKERS = 4 # workers of the cluster started when none is running
+
+
+def read_amplification(da, indexers):
+    # Elements pulled from storage (whole chunks) per element actually
+    # wanted, for an isel with `indexers` given as {dim: (start, stop)}
+    wanted = touched = n_chunks = 1
+    for dim, sizes in zip(da.dims, da.chunks):
+        start, stop = indexers.get(dim, (0, da.sizes[dim]))
+        bounds = np.cumsum((0,) + tuple(sizes))
+        first = np.searchsorted(bounds, start, side='right') - 1
+        last = np.searchsorted(bounds, stop - 1, side='right') - 1
+        wanted *= stop - start
+        touched *= bounds[last + 1] - bounds[first]
+        n_chunks *= last - first + 1
+    return dict(chunks=int(n_chunks), amplification=float(touched / wanted))
+
+
+def access_patterns(da):
+    eta, xi = da.sizes['eta_rho'] // 2, da.sizes['xi_rho'] // 2
+    return {
+        'map': {'ocean_time': (0, 1), 's_rho': (0, 1)},
+        'series': {
+            's_rho': (0, 1),
+            'eta_rho': (eta, eta + TAP_CELLS),
+            'xi_rho': (xi, xi + TAP_CELLS),
+        },
+    }
+
+
+def layout_report(store, variable='temp'):
+    # "before": both access patterns served from the map layout alone;
+    # "after": each access routed to its own layout. A cycle served from
+    # its memory-mapped arrays is reported on the Zarr layouts beside them.
+    if store.map[variable].chunks is None and store.path is not None:
+        store = ForecastStore.open(store.path, serving=False)
+    patterns = access_patterns(store.map[variable])
+    routed = {'map': store.map, 'series': store.series}
+    return {
+        'before': {
+            access: read_amplification(store.map[variable], indexers)
+            for access, indexers in patterns.items()
+        },
+        'after': {
+            access: read_amplification(routed[access][variable], indexers)
+            for access, indexers in patterns.items()
+        },
+    }
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def _summary(seconds):
+    return dict(
+        runs=len(seconds),
+        min=float(np.min(seconds)),
+        median=float(np.median(seconds)),
+        max=float(np.max(seconds)),
+    )
+
+
+def headless_viewer(store):
+    # A COAWST_Viewer on `store` with its sidebar and map panes set up but
+    # no render scheduled, so every stage can be timed on its own
+    set_shared_store(store)
+    with mock.patch.object(pn.state, 'execute', lambda *args, **kwargs: None):
+        import app
+        viewer = app.COAWST_Viewer()
+        viewer._get_client()
+        viewer._populate_sidebar()
+        viewer._populate_main()
+    return viewer
+
+
+def _tap_points(viewer, n):
+    # Display coordinates of n wet rho points spread over the grid, a fresh
+    # one per run so the timeseries cache never answers
+    ds = viewer._roms_ds
+    wet = np.flatnonzero(ds.mask_rho.values > 0) if 'mask_rho' in ds.coords else np.arange(ds.x_rho.size)
+    picks = wet[np.linspace(len(wet)//4, 3*len(wet)//4, n).astype(int)]
+    return list(zip(ds.x_rho.values.ravel()[picks], ds.y_rho.values.ravel()[picks]))
+
+
+def time_viewer(viewer, repeat=REPEAT, time_index=0, depth='Surface'):
+    # Seconds per hot path, each run starting from an empty render cache:
+    # reading a panel's fields, building its overlay, rendering it to a
+    # Bokeh figure (datashading included) and serializing that figure, plus
+    # the tap timeseries and destaggering the currents
+    import app
+    panels = {
+        'salt': (['salt','evaporation'], partial(viewer._update_salt_plot, time_index, depth)),
+        'wave': (['Hwave','Dwave'], partial(viewer._update_wave_plot, time_index)),
+        'current': (['mag','angle'], partial(viewer._update_current_plot, time_index, depth)),
+        'temperature': (['temp','zeta'], partial(viewer._update_temperature_plot, time_index, depth)),
+    }
+    timings = {}
+    record = lambda stage, seconds: timings.setdefault(stage, []).append(seconds)
+    for x, y in _tap_points(viewer, repeat):
+        viewer._render_cache.clear()
+        for panel, (names, build) in panels.items():
+            _, seconds = _timed(viewer._source.fields, names, time_index, depth)
+            record(f'{panel}.fields', seconds)
+            plot, seconds = _timed(build)
+            record(f'{panel}.build', seconds)
+            figure, seconds = _timed(partial(hv.render, backend='bokeh'), plot)
+            record(f'{panel}.render', seconds)
+            _, seconds = _timed(json_item, figure)
+            record(f'{panel}.serialize', seconds)
+        _, seconds = _timed(viewer._extract_timeseries, x, y, depth, viewer._version)
+        record('timeseries.extract', seconds)
+        for var in app.TIMESERIES:
+            _, seconds = _timed(viewer._update_timeseries, var, x, y, depth)
+            record(f'timeseries.{var}', seconds)
+        ds = decode_dataset(viewer._store.map[['u','v','temp']].isel(ocean_time=time_index))
+        _, seconds = _timed(lambda: add_current_fields(ds).mag.compute())
+        record('destagger', seconds)
+    return {stage: _summary(seconds) for stage, seconds in timings.items()}
+
+
+def _connect(workers=BENCH_WORKERS):
+    # The viewer's cluster when one is running, else a fixed-size one here
+    try:
+        return Client(DASK_SCHEDULER_ADDRESS, timeout=2), None
+    except OSError:
+        cluster = LocalCluster(scheduler_port=DASK_SCHEDULER_PORT, n_workers=workers)
+        return Client(cluster), cluster
+
+
+def run(store, repeat=REPEAT, workers=BENCH_WORKERS, variable='temp'):
+    client, cluster = _connect(workers)
+    viewer = None
+    try:
+        viewer = headless_viewer(store)
+        ds = store.map
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'grid': {dim: int(ds.sizes[dim]) for dim in ('ocean_time','s_rho','eta_rho','xi_rho')},
+            'workers': len(client.scheduler_info()['workers']),
+            'layout': layout_report(store, variable),
+            'timings': time_viewer(viewer, repeat),
+        }
+    finally:
+        if viewer is not None:
+            viewer._get_client().close()
+        client.close()
+        if cluster is not None:
+            cluster.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read amplification of the store layouts and, with --timings, headless timings of the viewer hot paths (JSON)')
+    parser.add_argument('--store', default=STORE_PATH)
+    parser.add_argument('--variable', default='temp')
+    parser.add_argument('--timings', action='store_true', help='time the panels, timeseries and destaggering too')
+    parser.add_argument('--synthetic', action='store_true', help='use a generated COAWST-like dataset instead of --store')
+    parser.add_argument('--shape', type=int, nargs=2, default=USEAST_SHAPE, metavar=('ETA', 'XI'))
+    parser.add_argument('--times', type=int, default=N_TIMES)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--workers', type=int, default=BENCH_WORKERS)
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args()
+    if args.synthetic:
+        store = ForecastStore(subset(make_dataset(tuple(args.shape), args.times), window=args.times))
+    else:
+        store = ForecastStore.open(args.store)
+    if args.timings:
+        report = run(store, args.repeat, args.workers, args.variable)
+    else:
+        report = layout_report(store, args.variable)
+    report = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# coding: utf-8
+# cache.py
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+RENDER_CACHE_BYTES = int(os.environ.get('COAWST_RENDER_CACHE_BYTES', 2*1024**3))
+
+_MISSING = object()
+
+
+def _sizeof(value):
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is None:
+        nbytes = sys.getsizeof(value)
+    return int(nbytes)
+
+
+class RenderCache:
+    # Process-wide LRU of the reduced fields behind the map panels, bounded
+    # by a byte budget. Keys end with the dataset version, and entries from
+    # any other version are dropped when a new forecast cycle is loaded.
+    # Results from another version that land after the switch (a render or
+    # prefetch that started before it) are returned but never stored.
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.version = None
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetch_used = 0
+        self.prefetch_wasted = 0
+        self._prefetched = set()
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if key in self._prefetched:
+                self._prefetched.discard(key)
+                self.prefetch_used += 1
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes=None, prefetched=False):
+        if nbytes is None:
+            nbytes = _sizeof(value)
+        with self._lock:
+            if self.version is not None and key[-1] != self.version:
+                return value
+            if key in self._entries:
+                self._drop(key)
+            if nbytes > self.max_bytes:
+                return value
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            if prefetched:
+                self._prefetched.add(key)
+            while self.nbytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return value
+
+    def get_or_compute(self, key, func):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.put(key, func())
+        return value
+
+    def set_version(self, version):
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            for key in [key for key in self._entries if key[-1] != version]:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._prefetched.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                entries=len(self._entries),
+                nbytes=self.nbytes,
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                prefetch_used=self.prefetch_used,
+                prefetch_wasted=self.prefetch_wasted,
+                version=self.version,
+            )
+
+    def _drop(self, key):
+        _, nbytes = self._entries.pop(key)
+        self.nbytes -= nbytes
+        if key in self._prefetched:
+            # prefetched but never read before it was evicted or replaced
+            self._prefetched.discard(key)
+            self.prefetch_wasted += 1
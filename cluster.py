@@ -1,13 +1,45 @@
 #!/usr/bin/env python
 # coding: utf-8
 # cluster.py
-from dask.distributed import LocalCluster
+import os
+
+from dask.distributed import Client, LocalCluster
+from distributed.system import MEMORY_LIMIT
 
 DASK_SCHEDULER_PORT = 64719
 DASK_SCHEDULER_ADDRESS = f"tcp://127.0.0.1:{DASK_SCHEDULER_PORT}"
 N_WORKERS = 12
+MIN_WORKERS = int(os.environ.get('COAWST_MIN_WORKERS', 2))
+MAX_WORKERS = int(os.environ.get('COAWST_MAX_WORKERS', N_WORKERS))
+# Per worker; by default the machine's memory split over the largest the
+# cluster can grow to, so a fully scaled cluster still fits
+WORKER_MEMORY = os.environ.get('COAWST_WORKER_MEMORY') or MEMORY_LIMIT//MAX_WORKERS
+# Backlog the adaptive scaler tries to be able to clear in this long
+TARGET_DURATION = os.environ.get('COAWST_TARGET_DURATION', '5s')
+
+
+def start_cluster():
+    # Workers are added while tasks queue up or memory fills and retired
+    # again once the cluster is idle
+    cluster = LocalCluster(
+        scheduler_port=DASK_SCHEDULER_PORT,
+        n_workers=MIN_WORKERS,
+        memory_limit=WORKER_MEMORY,
+    )
+    cluster.adapt(
+        minimum=MIN_WORKERS,
+        maximum=MAX_WORKERS,
+        target_duration=TARGET_DURATION,
+    )
+    return cluster
+
 
 if __name__ == '__main__':
-    cluster = LocalCluster(scheduler_port=DASK_SCHEDULER_PORT, n_workers=N_WORKERS)
+    cluster = start_cluster()
     print(cluster.scheduler_address)
-    input()
\ No newline at end of file
+    from store import SHARE_DATASET, shared_store
+    if SHARE_DATASET:
+        # persist and publish the working set before the first app process asks
+        with Client(cluster) as client:
+            print(shared_store().share(client).version)
+    input()
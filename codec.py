@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf-8
+# codec.py
+import os
+
+import numpy as np
+
+COMPACT_FIELDS = os.environ.get('COAWST_COMPACT_FIELDS', '0') == '1'
+LEVELS = 65535 # uint16 codes for values; the last code marks missing cells
+MISSING = LEVELS
+# Fixed physical range of each field that is held compactly. Values are
+# clipped to it and decode to within half a step, (hi-lo)/131068, of the
+# original, plus float32 rounding (under 3e-6 for every range here):
+#   temp   -5..40 deg C    0.00034 deg C
+#   salt    0..45          0.00034
+#   zeta  -10..10 m        0.00015 m
+#   Hwave   0..30 m        0.00023 m
+#   Dwave   0..360 deg     0.0027 deg
+#   u, v, u_rho, v_rho  -5..5 m/s  0.000076 m/s
+#   mag     0..8 m/s       0.000061 m/s
+#   angle  pi/2..5pi/2     0.000048 rad
+# evaporation has no fixed range (tiny values of either sign) and stays
+# float32.
+FIELD_RANGES = {
+    'temp': (-5.0, 40.0),
+    'salt': (0.0, 45.0),
+    'zeta': (-10.0, 10.0),
+    'Hwave': (0.0, 30.0),
+    'Dwave': (0.0, 360.0),
+    'u': (-5.0, 5.0),
+    'v': (-5.0, 5.0),
+    'u_rho': (-5.0, 5.0),
+    'v_rho': (-5.0, 5.0),
+    'mag': (0.0, 8.0),
+    'angle': (np.pi/2, 5*np.pi/2),
+}
+
+
+def error_bound(name):
+    # Largest decoding error of a value inside the field's range, in its
+    # own units
+    lo, hi = FIELD_RANGES[name]
+    return (hi-lo)/(2*(LEVELS-1)) + max(abs(lo), abs(hi))*2.0**-24
+
+
+def encode(da):
+    # uint16 codes spread linearly over the field's range, with NaN (land
+    # and any other missing cell) as MISSING. Works lazily on dask arrays;
+    # the range travels in the attrs so decode needs nothing else.
+    lo, hi = FIELD_RANGES[da.name]
+    codes = ((da.astype('f8').clip(lo, hi)-lo)*((LEVELS-1)/(hi-lo))).round()
+    codes = codes.fillna(MISSING).astype('u2')
+    codes.attrs = {**da.attrs, 'compact_range': (lo, hi)}
+    return codes
+
+
+def decode(da):
+    # float32 values of an encoded field; anything else is returned as is
+    if 'compact_range' not in da.attrs:
+        return da
+    lo, hi = da.attrs['compact_range']
+    values = (lo + da*((hi-lo)/(LEVELS-1))).astype('f4').where(da != MISSING)
+    values.attrs = {key: value for key, value in da.attrs.items() if key != 'compact_range'}
+    return values
+
+
+def encode_like(da, like):
+    # `da` encoded the way `like` is, e.g. a field derived from a decoded one
+    return encode(da) if 'compact_range' in like.attrs else da
+
+
+def encode_dataset(ds):
+    return ds.assign({
+        name: encode(ds[name]) for name in ds.data_vars
+        if name in FIELD_RANGES and 'compact_range' not in ds[name].attrs
+    })
+
+
+def decode_dataset(ds):
+    return ds.assign({name: decode(ds[name]) for name in ds.data_vars})
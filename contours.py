@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding: utf-8
+# contours.py
+import threading
+
+import numpy as np
+import contourpy
+
+CONTOUR_LEVELS = 5
+MAX_VERTICES = 20000 # per viewport
+MAX_ZOOM = 12
+REFERENCE_WIDTH = 800 # pixels a zoom level's tolerance is defined against
+
+
+def contour_levels(z, levels=CONTOUR_LEVELS):
+    # An int asks for that many evenly spaced levels inside the data range
+    if np.iterable(levels):
+        return tuple(float(level) for level in levels)
+    lo, hi = np.nanmin(z), np.nanmax(z)
+    return tuple(np.linspace(lo, hi, levels+2)[1:-1].tolist())
+
+
+def simplify(line, tolerance):
+    # Douglas-Peucker: drop vertices closer than `tolerance` to the chord
+    # of the span they sit in
+    if len(line) < 3:
+        return line
+    keep = np.zeros(len(line), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(line)-1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i+1:
+            continue
+        start, chord = line[i], line[j]-line[i]
+        offsets = line[i+1:j]-start
+        length = np.hypot(*chord)
+        if length == 0:
+            dist = np.hypot(offsets[:,0], offsets[:,1])
+        else:
+            dist = np.abs(chord[0]*offsets[:,1]-chord[1]*offsets[:,0])/length
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance:
+            keep[i+1+k] = True
+            stack += [(i, i+1+k), (i+1+k, j)]
+    return line[keep]
+
+
+class ContourSet:
+    # Contour lines of one field in display coordinates, plus a simplified
+    # copy per zoom level made on first use. Zoom level z has a tolerance of
+    # one pixel when 1/2**z of the domain width fills REFERENCE_WIDTH pixels.
+    def __init__(self, x, y, z, levels=CONTOUR_LEVELS):
+        z = np.ma.masked_invalid(np.asarray(z, dtype='f8'))
+        self.levels = contour_levels(z.compressed(), levels) if z.count() else ()
+        generator = contourpy.contour_generator(np.asarray(x), np.asarray(y), z, line_type='Separate')
+        self.lines = [
+            (level, line)
+            for level in self.levels
+            for line in generator.lines(level)
+            if len(line) > 1
+        ]
+        self.width = float(np.nanmax(x)-np.nanmin(x))
+        self._zooms = {}
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(line.nbytes for _, line in self.lines)
+
+    def simplified(self, zoom):
+        with self._lock:
+            if zoom not in self._zooms:
+                tolerance = self.width/2**zoom/REFERENCE_WIDTH
+                lines = [(level, simplify(line, tolerance)) for level, line in self.lines]
+                self._zooms[zoom] = [
+                    (level, line, (*line.min(axis=0), *line.max(axis=0)))
+                    for level, line in lines
+                ]
+            return self._zooms[zoom]
+
+    def paths(self, x_range=None, y_range=None):
+        # Paths for hv.Contours inside the viewport, simplified for its zoom
+        # level and coarsened further until they fit in MAX_VERTICES
+        x0, x1 = x_range or (-np.inf, np.inf)
+        y0, y1 = y_range or (-np.inf, np.inf)
+        zoom = 0
+        if x_range is not None and x1 > x0:
+            zoom = int(np.clip(np.round(np.log2(self.width/(x1-x0))), 0, MAX_ZOOM))
+        while True:
+            visible = [
+                (level, line) for level, line, (lx0, ly0, lx1, ly1) in self.simplified(zoom)
+                if lx1 >= x0 and lx0 <= x1 and ly1 >= y0 and ly0 <= y1
+            ]
+            if zoom == 0 or sum(len(line) for _, line in visible) <= MAX_VERTICES:
+                break
+            zoom -= 1
+        return [{'x': line[:,0], 'y': line[:,1], 'level': level} for level, line in visible]
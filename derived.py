@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# coding: utf-8
+# derived.py
+import numpy as np
+import xarray as xr
+
+CURRENT_FIELDS = ['u_rho','v_rho','mag','angle']
+RHO_DIMS = {'eta_u': 'eta_rho', 'xi_u': 'xi_rho', 'eta_v': 'eta_rho', 'xi_v': 'xi_rho'}
+
+
+def _to_rho(da, dim, like):
+    # Average neighbouring faces onto the rho points between them and repeat
+    # the edge values onto the outermost rho points, lazily for every time
+    # and level
+    var = da.variable
+    inner = 0.5*(var.isel({dim: slice(None,-1)}) + var.isel({dim: slice(1,None)}))
+    var = inner.pad({dim: (1,1)}, mode='edge')
+    var = xr.Variable([RHO_DIMS.get(d, d) for d in var.dims], var.data)
+    da = xr.DataArray(var, coords=like.coords).transpose(*like.dims)
+    if like.chunks is not None:
+        da = da.chunk(dict(zip(like.dims, like.chunks)))
+    return da
+
+
+def u_to_rho(ds):
+    return _to_rho(ds.u, 'xi_u', ds.temp)
+
+
+def v_to_rho(ds):
+    return _to_rho(ds.v, 'eta_v', ds.temp)
+
+
+def add_current_fields(ds):
+    ds = ds.copy()
+    ds['u_rho'] = u_to_rho(ds)
+    ds['v_rho'] = v_to_rho(ds)
+    ds['mag'] = np.hypot(ds.u_rho, ds.v_rho)
+    ds['angle'] = 3*np.pi/2 - np.arctan2(ds.v_rho, ds.u_rho)
+    return ds
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# coding: utf-8
+# ingest.py
+import os
+import glob
+import fcntl
+import shutil
+import argparse
+from contextlib import contextmanager
+
+import intake
+import numcodecs
+import numpy as np
+import xarray as xr
+
+from derived import add_current_fields
+from pyramid import build_pyramid, summarize
+from vertical import VERTICAL_COORDS
+
+CATALOG_URL = 'https://usgs-coawst.s3.amazonaws.com/useast-archive/coawst_intake.yml'
+CATALOG_ENTRY = 'COAWST-USEAST'
+STORE_PATH = os.environ.get('COAWST_STORE', './coawst.zarr')
+VARIABLES = ['temp','zeta','u','v','Hwave','Dwave','salt','evaporation']
+S_RHO_LEVELS = [0,7,15]
+WINDOW = 72 #hours
+KEEP_CYCLES = 2 # cycle directories kept beside the store, the served one included
+COMPRESSOR = numcodecs.Blosc(cname='zstd', clevel=3, shuffle=numcodecs.Blosc.BITSHUFFLE)
+
+# One time step and level per chunk, full grid: what the map panels read
+MAP_CHUNKS = {
+    'ocean_time': 1, 's_rho': 1,
+    'eta_rho': -1, 'xi_rho': -1,
+    'eta_u': -1, 'xi_u': -1,
+    'eta_v': -1, 'xi_v': -1,
+}
+# The whole window per chunk over small tiles: what the timeseries read
+SERIES_TILE = 32
+SERIES_CHUNKS = {
+    'ocean_time': -1, 's_rho': 1,
+    'eta_rho': SERIES_TILE, 'xi_rho': SERIES_TILE,
+    'eta_u': SERIES_TILE, 'xi_u': SERIES_TILE,
+    'eta_v': SERIES_TILE, 'xi_v': SERIES_TILE,
+}
+LAYOUTS = {'map': MAP_CHUNKS, 'series': SERIES_CHUNKS}
+
+
+def open_source(source=CATALOG_URL):
+    # The USGS intake catalog, or a local Zarr store / netCDF file with the
+    # same layout (used to run the pipeline offline)
+    if source.endswith(('.yml', '.yaml')):
+        return intake.open_catalog(source)[CATALOG_ENTRY].to_dask()
+    if source.rstrip('/').endswith('.zarr'):
+        return xr.open_zarr(source)
+    return xr.open_dataset(source, chunks={})
+
+
+def subset(ds, levels=S_RHO_LEVELS, window=WINDOW):
+    # The grid mask and vertical grid travel as coordinates of the fields
+    ds = ds.set_coords([name for name in ['mask_rho', *VERTICAL_COORDS] if name in ds.data_vars])
+    return ds[VARIABLES].isel(
+        s_rho=list(levels),
+        ocean_time=slice(-window,None),
+    )
+
+
+def write_store(ds, path=STORE_PATH, chunks=MAP_CHUNKS, group=None):
+    ds = ds.drop_encoding()
+    ds = ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims})
+    encoding = {name: {'compressors': [COMPRESSOR]} for name in ds.variables}
+    ds.to_zarr(
+        path, group=group, mode='w', encoding=encoding,
+        consolidated=True, zarr_format=2,
+    )
+    return path
+
+
+def open_store(path=STORE_PATH, group=None):
+    return xr.open_zarr(path, group=group, consolidated=True)
+
+
+def store_groups(ds):
+    # Every group of a store, (dataset, chunks) by group name
+    groups = {group: (ds, chunks) for group, chunks in LAYOUTS.items()}
+    for factor, level in {1: ds, **build_pyramid(ds)}.items():
+        if factor > 1:
+            groups[f'pyramid/{factor}'] = (level, MAP_CHUNKS)
+        groups[f'summary/{factor}'] = (summarize(level), MAP_CHUNKS)
+    return groups
+
+
+def cycle_path(path, ds):
+    # Directory of the forecast cycle ending at the last time step of ds
+    stamp = np.datetime_as_string(ds.ocean_time.values[-1], unit='s')
+    return f"{path}.{stamp.replace(':', '')}"
+
+
+def _swap(path, target):
+    # Point `path` at `target` in one rename, then drop cycles beyond the
+    # newest KEEP_CYCLES. Readers resolve the link when they open the store,
+    # so an open store never sees another cycle's files.
+    link = f'{path}.swap'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(target), link)
+    os.replace(link, path)
+    cycles = sorted(
+        d for d in glob.glob(f'{glob.escape(path)}.*')
+        if os.path.isdir(d) and not os.path.islink(d) and not d.endswith('.tmp')
+    )
+    for old in cycles[:-KEEP_CYCLES]:
+        if old != target:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+@contextmanager
+def writer_lock(path=STORE_PATH):
+    # Cycles of a store have one writer at a time; yields False, without
+    # waiting, while another process holds the lock
+    with open(f'{path}.lock', 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_cycle(path, target, groups, prepare=None):
+    # Write `groups` ({group: (dataset, chunks)}) to a scratch sibling of
+    # `target`, finish it with `prepare(directory)`, then move it into place
+    # and swap it in. The cycle being served is never written: a rerun of
+    # the same cycle would rewrite files its readers still resolve to.
+    if os.path.realpath(path) == os.path.abspath(target):
+        raise FileExistsError(f'{target} is the cycle being served')
+    tmp = f'{target}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    for group, (data, chunks) in groups.items():
+        write_store(data, tmp, chunks, group)
+    if prepare is not None:
+        prepare(tmp)
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(tmp, target)
+    _swap(path, target)
+    return target
+
+
+def ingest(source=CATALOG_URL, path=STORE_PATH, levels=S_RHO_LEVELS, window=WINDOW, prepare=None):
+    # `prepare(directory)` finishes a written cycle before it is swapped in
+    ds = add_current_fields(subset(open_source(source), levels, window))
+    return _write_cycle(path, cycle_path(path, ds), store_groups(ds), prepare)
+
+
+def update(source=CATALOG_URL, path=STORE_PATH, levels=S_RHO_LEVELS, window=WINDOW, prepare=None):
+    # Roll the mirror forward to the newest time steps in `source`. Only the
+    # new steps are read and derived; the rest of the window is copied from
+    # the current cycle. Returns the new cycle, or None if nothing is new.
+    if not os.path.exists(path):
+        return ingest(source, path, levels, window, prepare)
+    current = os.path.realpath(path)
+    if current == os.path.abspath(path):
+        # a mirror written before cycles were versioned is moved aside once
+        current = cycle_path(path, open_store(path, 'map'))
+        os.rename(path, current)
+        _swap(path, current)
+    last = open_store(current, 'map').ocean_time.values[-1]
+    src = open_source(source)
+    new = src.ocean_time.values > last
+    if not new.any():
+        return None
+    fresh = add_current_fields(subset(src.isel(ocean_time=new), levels, window))
+    keep = max(window-fresh.sizes['ocean_time'], 0)
+    groups = store_groups(fresh)
+    if keep:
+        groups = {
+            group: (xr.concat(
+                [open_store(current, group).isel(ocean_time=slice(-keep, None)), data],
+                'ocean_time', data_vars='minimal', coords='minimal', compat='override',
+            ), chunks)
+            for group, (data, chunks) in groups.items()
+        }
+    return _write_cycle(path, cycle_path(path, fresh), groups, prepare)
+
+
+if __name__ == '__main__':
+    from precompute import PRECOMPUTE, precompute_cycle
+    # The only writer of the mirror: run it, e.g. from cron, with --update;
+    # the viewer processes adopt each new cycle (store.refresh_store)
+    parser = argparse.ArgumentParser(description='Mirror the COAWST forecast window into a local Zarr store (map and series layouts)')
+    parser.add_argument('--source', default=CATALOG_URL, help='intake catalog URL, Zarr store or netCDF file')
+    parser.add_argument('--store', default=STORE_PATH)
+    parser.add_argument('--levels', type=int, nargs='+', default=S_RHO_LEVELS)
+    parser.add_argument('--window', type=int, default=WINDOW)
+    parser.add_argument('--update', action='store_true', help='only ingest time steps newer than the current cycle')
+    args = parser.parse_args()
+    run = update if args.update else ingest
+    with writer_lock(args.store) as locked:
+        if not locked:
+            raise SystemExit(f'{args.store} is being written by another process')
+        # a precomputed cycle is served from its memory maps from the start
+        prepare = precompute_cycle if PRECOMPUTE else None
+        try:
+            target = run(args.source, args.store, args.levels, args.window, prepare)
+        except FileExistsError as e:
+            raise SystemExit(f'{e}; rerun with --update once the source has newer steps')
+    print(target)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding: utf-8
+# metrics.py
+import os
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import tornado.web
+from dask.distributed import performance_report
+
+METRICS_ROOT = os.environ.get('COAWST_METRICS_ROOT', '/metrics')
+# seconds a render must take for its dask performance report to be kept,
+# 0 disables the reports
+REPORT_SECONDS = float(os.environ.get('COAWST_REPORT_SECONDS', 0))
+REPORT_DIR = os.environ.get('COAWST_REPORT_DIR', './reports')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) #seconds
+STAGE_LABELS = ('stage', 'variable', 'depth', 'cache')
+# process-wide objects whose stats() are exposed as gauges, by name
+_STATS = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, **extra):
+    pairs = [*zip(names, values), *extra.items()]
+    return '{%s}' % ','.join(f'{name}="{_escape(value)}"' for name, value in pairs)
+
+
+class Histogram:
+    # Latency histogram with one series per label set, kept in this process
+    # and written out in the Prometheus text format
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple('' if labels.get(name) is None else str(labels[name]) for name in self.labels)
+        bucket = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self._lock:
+            counts, total = self._series.get(key, ([0]*(len(self.buckets)+1), 0.0))
+            counts[bucket] += 1
+            self._series[key] = (counts, total+seconds)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip([*self.buckets, '+Inf'], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, le=bound)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    'coawst_stage_seconds',
+    'Time spent in each stage of a render or timeseries callback',
+    STAGE_LABELS,
+)
+
+
+@contextmanager
+def span(stage, variable=None, depth=None, cache=None):
+    # Times the block as one `stage`. The yielded tags can be changed inside
+    # it, e.g. to mark a cache miss once it is known. Lead time is not a
+    # label, to keep the number of series bounded.
+    tags = dict(variable=variable, depth=depth, cache=cache)
+    start = time.perf_counter()
+    try:
+        yield tags
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter()-start, stage=stage, **tags)
+
+
+def timed(operation, stage, variable=None, depth=None):
+    # An instance of a HoloViews operation (e.g. rasterize) whose every
+    # application is observed as `stage`
+    def start(op, element):
+        return {'span_start': time.perf_counter()}
+    def stop(op, element, span_start=None, **kwargs):
+        if span_start is not None:
+            STAGE_SECONDS.observe(time.perf_counter()-span_start, stage=stage, variable=variable, depth=depth)
+        return element
+    op = operation.instance()
+    op._preprocess_hooks = [*op._preprocess_hooks, start]
+    op._postprocess_hooks = [*op._postprocess_hooks, stop]
+    return op
+
+
+class slow_report:
+    # Records a dask performance report around an async block and writes it
+    # to REPORT_DIR only if the block took REPORT_SECONDS or more. The report
+    # covers everything the cluster ran meanwhile, other sessions included.
+    def __init__(self, name, threshold=REPORT_SECONDS, directory=REPORT_DIR):
+        self.name = name
+        self.threshold = threshold
+        self.directory = directory
+        self._report = None
+
+    async def __aenter__(self):
+        self._start = time.perf_counter()
+        if self.threshold:
+            stamp = time.strftime('%Y%m%dT%H%M%S')
+            filename = os.path.join(self.directory, f'{self.name}-{stamp}.html')
+            report = performance_report(filename=filename)
+            await asyncio.to_thread(report.__enter__)
+            self._report = report
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._report is None or time.perf_counter()-self._start < self.threshold:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        await asyncio.to_thread(self._report.__exit__, *exc_info)
+
+
+def register_stats(name, obj):
+    # Called by whoever creates a process-wide object with a stats() method
+    # (the render cache, the prefetcher); returns the object
+    _STATS[name] = obj
+    return obj
+
+
+def _stats_lines(prefix, stats):
+    lines = []
+    for stat, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines += [f'# TYPE {prefix}_{stat} gauge', f'{prefix}_{stat} {value}']
+    return lines
+
+
+def exposition():
+    # Stage histograms plus the counters of the registered objects, once
+    # they have been created
+    lines = STAGE_SECONDS.expose()
+    for name, obj in list(_STATS.items()):
+        lines += _stats_lines(f'coawst_{name}', obj.stats())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    # GET /metrics
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(exposition())
+
+
+# Served next to the viewer with `panel serve app.py --plugins tiles metrics`
+ROUTES = [
+    (METRICS_ROOT, MetricsHandler, {}),
+]
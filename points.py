@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding: utf-8
+# points.py
+import os
+import json
+
+import dask
+import numpy as np
+import panel as pn
+import tornado.web
+import xarray as xr
+from tornado.ioloop import IOLoop
+
+from codec import decode, decode_dataset
+from metrics import span
+from spatial import RhoIndex
+from store import shared_store
+from vertical import VerticalGrid, depth_choices, has_vertical_grid, select_depth, z_depth
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+POINTS_ROOT = os.environ.get('COAWST_POINTS_ROOT', '/timeseries')
+MAX_POINTS = int(os.environ.get('COAWST_MAX_POINTS', 1000)) # per request
+POINT_DISTANCE = 7 #km, farthest a point may be from a wet rho point
+POINT_VARIABLES = ['temp','salt','zeta','Hwave','mag']
+ARROW_TYPE = 'application/vnd.apache.arrow.stream'
+
+
+class PointSource:
+    # Point timeseries of the served store. Every point is resolved to its
+    # nearest wet rho point with the index the viewer's taps use, and all
+    # variables are read for all points in one vectorized gather from the
+    # timeseries layout.
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+        self.depths = depth_choices(store.map)
+        # only fields on the rho grid the index resolves points to
+        self.variables = [
+            name for name in store.series.data_vars
+            if name in store.map.data_vars and {'eta_rho', 'xi_rho'} <= set(store.series[name].dims)
+        ]
+        self.vertical = VerticalGrid(store.map) if has_vertical_grid(store.map) else None
+
+    def extract(self, lon, lat, variables=POINT_VARIABLES, depth='Surface'):
+        # Dataset of every variable over (point, ocean_time); points that
+        # are not in the domain have found=False and NaN values
+        eta, xi, found = self.index.nearest(lon, lat, POINT_DISTANCE)
+        cells = dict(eta_rho=xr.DataArray(eta, dims='point'), xi_rho=xr.DataArray(xi, dims='point'))
+        series = self.store.series
+        weights = None
+        if self.vertical is not None and z_depth(depth) is not None:
+            zeta = decode(series['zeta']).isel(**cells)
+            weights = self.vertical.weights(zeta, z_depth(depth), cells)
+        ds = decode_dataset(series[variables]).isel(**cells)
+        fields = {name: select_depth(ds[name], depth, weights) for name in variables}
+        with span('points', '+'.join(variables), depth):
+            fields, = dask.compute(fields)
+        hit = xr.DataArray(found, dims='point')
+        return xr.Dataset(
+            {name: field.reset_coords(drop=True).where(hit) for name, field in fields.items()},
+            coords=dict(
+                lon=('point', np.asarray(lon, dtype='f8')),
+                lat=('point', np.asarray(lat, dtype='f8')),
+                found=hit,
+                ocean_time=series.ocean_time.values,
+            ),
+        ).transpose('point', 'ocean_time')
+
+
+def point_source():
+    # Rebuilt whenever the shared store moves to a new forecast cycle
+    store = shared_store()
+    source = pn.state.cache.get('point_source')
+    if source is None or source.store is not store:
+        ds = store.map
+        mask = ds.mask_rho.values if 'mask_rho' in ds.coords else None
+        # the same index as the viewer sessions'
+        index = pn.state.as_cached('rho_index', lambda: RhoIndex(ds.lon_rho.values, ds.lat_rho.values, mask))
+        source = pn.state.cache['point_source'] = PointSource(store, index)
+    return source
+
+
+def to_json(ds):
+    # Built from whole arrays, one list per variable and point
+    def rows(da):
+        values = da.values.astype('f8')
+        rows = values.astype(object)
+        rows[np.isnan(values)] = None
+        return rows.tolist()
+    columns = {name: rows(ds[name]) for name in ds.data_vars}
+    lon, lat, found = ds.lon.values.tolist(), ds.lat.values.tolist(), ds.found.values.tolist()
+    return json.dumps({
+        'ocean_time': np.datetime_as_string(ds.ocean_time.values, unit='s').tolist(),
+        'points': [
+            dict(
+                lon=lon[i], lat=lat[i], found=found[i],
+                **{name: column[i] for name, column in columns.items()},
+            )
+            for i in range(len(lon))
+        ],
+    })
+
+
+def to_arrow(ds):
+    # One row per point and time step
+    n_points, n_times = ds.sizes['point'], ds.sizes['ocean_time']
+    columns = {
+        'point': np.repeat(np.arange(n_points, dtype='i4'), n_times),
+        'lon': np.repeat(ds.lon.values, n_times),
+        'lat': np.repeat(ds.lat.values, n_times),
+        'ocean_time': np.tile(ds.ocean_time.values, n_points),
+        **{name: ds[name].values.astype('f4').ravel() for name in ds.data_vars},
+    }
+    table = pa.table(columns)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def respond(source, lon, lat, variables, depth, fmt):
+    # The response body, extracted and serialized off the event loop
+    ds = source.extract(lon, lat, variables, depth)
+    return to_arrow(ds) if fmt == 'arrow' else to_json(ds)
+
+
+class PointsHandler(tornado.web.RequestHandler):
+    # GET  /timeseries?points=lon,lat;lon,lat&depth=Surface&variables=temp,salt&format=json
+    # POST /timeseries {"points": [[lon, lat], ...], "depth": ..., "variables": [...], "format": ...}
+    # Arrow IPC is returned for format=arrow or an Accept header asking for it.
+    async def get(self):
+        try:
+            points = [
+                tuple(float(v) for v in point.split(','))
+                for point in self.get_argument('points').split(';') if point
+            ]
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'points must be lon,lat;lon,lat')
+        variables = self.get_argument('variables', None)
+        await self._respond(
+            points,
+            self.get_argument('depth', 'Surface'),
+            variables.split(',') if variables else POINT_VARIABLES,
+            self.get_argument('format', None),
+        )
+
+    async def post(self):
+        try:
+            body = json.loads(self.request.body or b'{}')
+            points = [tuple(float(v) for v in point) for point in body['points']]
+        except (ValueError, KeyError, TypeError):
+            raise tornado.web.HTTPError(400, 'body must be JSON with "points": [[lon, lat], ...]')
+        await self._respond(
+            points,
+            body.get('depth', 'Surface'),
+            body.get('variables', POINT_VARIABLES),
+            body.get('format'),
+        )
+
+    async def _respond(self, points, depth, variables, fmt):
+        source = point_source()
+        if isinstance(variables, str):
+            variables = variables.split(',')
+        if not isinstance(variables, list) or not all(isinstance(name, str) for name in variables):
+            raise tornado.web.HTTPError(400, 'variables must be a name or a list of names')
+        if not points or any(len(point) != 2 for point in points):
+            raise tornado.web.HTTPError(400, 'points must be lon/lat pairs')
+        if len(points) > MAX_POINTS:
+            raise tornado.web.HTTPError(413, f'at most {MAX_POINTS} points per request')
+        if depth not in source.depths:
+            raise tornado.web.HTTPError(400, f'depth must be one of {source.depths}')
+        unknown = [name for name in variables if name not in source.variables]
+        if unknown:
+            raise tornado.web.HTTPError(400, f'unknown variables {unknown}')
+        if fmt is None:
+            fmt = 'arrow' if ARROW_TYPE in self.request.headers.get('Accept', '') else 'json'
+        if fmt not in ('arrow', 'json'):
+            raise tornado.web.HTTPError(400, 'format must be arrow or json')
+        if fmt == 'arrow' and pa is None:
+            raise tornado.web.HTTPError(406, 'pyarrow is not installed')
+        lon, lat = np.array(points, dtype='f8').T
+        # float() and JSON both let nan and inf through
+        if not (np.isfinite(lon).all() and np.isfinite(lat).all()):
+            raise tornado.web.HTTPError(400, 'points must be finite')
+        body = await IOLoop.current().run_in_executor(
+            None, respond, source, lon, lat, list(variables), depth, fmt
+        )
+        self.set_header('Content-Type', ARROW_TYPE if fmt == 'arrow' else 'application/json')
+        self.write(body)
+
+
+# Served next to the viewer with `panel serve app.py --plugins tiles metrics points`
+ROUTES = [
+    (POINTS_ROOT, PointsHandler, {}),
+]
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding: utf-8
+# precompute.py
+import os
+import json
+import shutil
+import argparse
+
+import numpy as np
+import xarray as xr
+
+from ingest import STORE_PATH
+
+SERVING_DIR = 'serving' # inside a cycle directory
+# have ingest.py write the serving arrays of every new cycle it makes
+PRECOMPUTE = os.environ.get('COAWST_PRECOMPUTE', '0') == '1'
+
+
+def _write_array(path, da):
+    # One uncompressed .npy per variable, filled a time step at a time so a
+    # lazy field is never held in memory whole
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=da.dtype, shape=da.shape)
+    if da.chunks is not None and da.dims and da.dims[0] == 'ocean_time':
+        for i in range(da.shape[0]):
+            out[i] = da[i].values
+    else:
+        out[...] = da.values
+    out.flush()
+    del out
+
+
+def write_serving(cycle, groups):
+    # The arrays a viewer process serves from, as they are once opened:
+    # Web Mercator grid, land mask, derived currents and pyramid levels
+    # with their own grids, each field already encoded if COMPACT_FIELDS is
+    # set. `groups` maps group names ('map', 'pyramid/<factor>') to the
+    # ForecastStore datasets. Written beside the cycle's Zarr groups and
+    # moved into place in one rename.
+    target = os.path.join(cycle, SERVING_DIR)
+    tmp = f'{target}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    for group, ds in groups.items():
+        directory = os.path.join(tmp, group)
+        os.makedirs(directory)
+        layout = {}
+        for name, da in ds.variables.items():
+            _write_array(os.path.join(directory, f'{name}.npy'), da)
+            layout[name] = dict(
+                dims=list(da.dims),
+                coord=name in ds.coords,
+                attrs={key: value for key, value in da.attrs.items() if key == 'compact_range'},
+            )
+        with open(os.path.join(directory, 'layout.json'), 'w') as f:
+            json.dump(layout, f)
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(tmp, target)
+    return target
+
+
+def precompute_cycle(cycle):
+    # Serving arrays of the cycle directory `cycle`, from its Zarr groups
+    from store import ForecastStore
+    return write_serving(cycle, ForecastStore.open(cycle, serving=False).serving_groups())
+
+
+def open_serving(cycle):
+    # {group: Dataset} backed by read-only memory maps, so every process
+    # on the host shares one copy through the page cache; None if the
+    # cycle was never precomputed
+    root = os.path.join(cycle, SERVING_DIR)
+    if not os.path.isdir(root):
+        return None
+    groups = {}
+    for directory, _, files in os.walk(root):
+        if 'layout.json' not in files:
+            continue
+        with open(os.path.join(directory, 'layout.json')) as f:
+            layout = json.load(f)
+        variables, coords = {}, {}
+        for name, spec in layout.items():
+            values = np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+            var = xr.Variable(spec['dims'], values, attrs={
+                key: tuple(value) for key, value in spec['attrs'].items()
+            })
+            (coords if spec['coord'] else variables)[name] = var
+        groups[os.path.relpath(directory, root)] = xr.Dataset(variables, coords=coords)
+    return groups
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the memory-mapped serving arrays of the current forecast cycle')
+    parser.add_argument('--store', default=STORE_PATH)
+    args = parser.parse_args()
+    print(precompute_cycle(os.path.realpath(args.store)))
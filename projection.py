@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# coding: utf-8
+# projection.py
+import os
+
+import numpy as np
+import cartopy.crs as ccrs
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+REGRID = os.environ.get('COAWST_REGRID', '0') == '1'
+
+
+def mercator_grid(lon, lat):
+    # Web Mercator x/y of a 2-D lon/lat grid, computed once per dataset so
+    # the map layers can be drawn without reprojecting on every render
+    xyz = ccrs.GOOGLE_MERCATOR.transform_points(
+        ccrs.PlateCarree(), np.asarray(lon, dtype='f8'), np.asarray(lat, dtype='f8'),
+    )
+    return xyz[...,0], xyz[...,1]
+
+
+class Regridder:
+    # Sparse inverse-distance weights from the curvilinear grid onto a
+    # regular Web Mercator grid of the same shape and extent. Target points
+    # further than 1.5 source cells from any grid point stay empty.
+    def __init__(self, x, y, k=4):
+        x = np.asarray(x, dtype='f8')
+        y = np.asarray(y, dtype='f8')
+        ny, nx = self.shape = x.shape
+        self.xs = np.linspace(np.nanmin(x), np.nanmax(x), nx)
+        self.ys = np.linspace(np.nanmin(y), np.nanmax(y), ny)
+        source = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        points = np.column_stack([x.ravel()[source], y.ravel()[source]])
+        tree = cKDTree(points)
+        k = min(k, len(source))
+        spacing = np.median(tree.query(points, k=2)[0][:,1])
+        spacing = max(spacing, self.xs[1]-self.xs[0], self.ys[1]-self.ys[0])
+        gx, gy = np.meshgrid(self.xs, self.ys)
+        dist, idx = tree.query(np.column_stack([gx.ravel(), gy.ravel()]), k=k)
+        weights = 1/np.maximum(dist, 1e-6*spacing)
+        weights[dist > 1.5*spacing] = 0
+        self.weights = sparse.csr_matrix(
+            (weights.ravel(), (np.repeat(np.arange(gx.size), k), source[idx].ravel())),
+            shape=(gx.size, x.size),
+        )
+
+    def __call__(self, values):
+        values = np.asarray(values, dtype='f8').ravel()
+        wet = np.isfinite(values)
+        total = self.weights @ np.where(wet, values, 0)
+        norm = self.weights @ wet
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(norm > 0, total/norm, np.nan).reshape(self.shape)
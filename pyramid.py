@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+# pyramid.py
+import numpy as np
+import xarray as xr
+
+from projection import mercator_grid
+
+PYRAMID_FACTORS = (1, 2, 4, 8, 16)
+PYRAMID_FIELDS = ['salt','Hwave','mag','temp']
+SUMMARY_TILE = 64 # cells per side of a summary tile, at every level
+TILE_DIMS = {'eta_rho': 'eta_tile', 'xi_rho': 'xi_tile'}
+
+
+def coarsen_masked(da, factor):
+    # Block means over factor x factor rho cells that only average wet cells;
+    # blocks that are all land stay NaN. Grid coordinates are block means too.
+    if factor == 1:
+        return da
+    wet = np.isfinite(da)
+    if 'mask_rho' in da.coords:
+        wet &= da.mask_rho > 0
+    blocks = dict(eta_rho=factor, xi_rho=factor)
+    total = da.where(wet, 0).coarsen(blocks, boundary='trim').sum()
+    count = wet.coarsen(blocks, boundary='trim').sum()
+    return (total/count).where(count > 0).rename(da.name)
+
+
+def build_pyramid(ds, names=PYRAMID_FIELDS, factors=PYRAMID_FACTORS):
+    return {
+        factor: ds[names].map(coarsen_masked, factor=factor)
+        for factor in factors if factor > 1
+    }
+
+
+def choose_factor(n_cells, pixels, factors=PYRAMID_FACTORS):
+    # Coarsest level that still puts at least one cell on every screen pixel
+    # across the viewport
+    for factor in sorted(factors, reverse=True):
+        if n_cells/factor >= pixels:
+            return factor
+    return min(factors)
+
+
+def _tiles(da, tile):
+    return da.coarsen(eta_rho=tile, xi_rho=tile, boundary='pad')
+
+
+def summarize(ds, names=PYRAMID_FIELDS, tile=SUMMARY_TILE):
+    # Min, max and missing-cell count of each field per tile x tile block of
+    # one pyramid level, for every time and depth, with each block's bounds
+    # in display coordinates. Land cells count as missing.
+    x, y = mercator_grid(ds.lon_rho.values, ds.lat_rho.values)
+    bounds = {}
+    for axis, values in (('x', x), ('y', y)):
+        tiles = _tiles(xr.DataArray(values, dims=ds.lon_rho.dims), tile)
+        bounds[f'{axis}_min'] = tiles.min().rename(TILE_DIMS)
+        bounds[f'{axis}_max'] = tiles.max().rename(TILE_DIMS)
+    summary = xr.Dataset(coords=bounds)
+    for name in names:
+        da = ds[name]
+        if 'mask_rho' in da.coords:
+            da = da.where(da.mask_rho > 0)
+        da = da.reset_coords(drop=True)
+        tiles = _tiles(da, tile)
+        summary[f'{name}_min'] = tiles.min().rename(TILE_DIMS)
+        summary[f'{name}_max'] = tiles.max().rename(TILE_DIMS)
+        summary[f'{name}_nan'] = _tiles(da.isnull(), tile).sum().astype('i4').rename(TILE_DIMS)
+    return summary
+
+
+def viewport_clim(summary, name, x_range=None, y_range=None):
+    # Colour limits over the viewport from the summaries of the tiles that
+    # overlap it, for a summary already selected for one time and depth.
+    # None when no wet tile is in view.
+    lo = np.asarray(summary[f'{name}_min'])
+    hi = np.asarray(summary[f'{name}_max'])
+    visible = np.isfinite(lo)
+    if x_range is not None:
+        visible &= (summary.x_max.values >= x_range[0]) & (summary.x_min.values <= x_range[1])
+    if y_range is not None:
+        visible &= (summary.y_max.values >= y_range[0]) & (summary.y_min.values <= y_range[1])
+    if not visible.any():
+        return None
+    return float(lo[visible].min()), float(hi[visible].max())
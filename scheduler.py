@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: utf-8
+# scheduler.py
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError
+from contextlib import contextmanager
+from functools import partial
+
+import dask
+import xarray as xr
+from dask import is_dask_collection
+from dask.distributed import Future
+
+COALESCE_DELAY = 0.15 # seconds a request waits for a newer one to replace it
+
+
+def _data(collection):
+    # What is sent to the cluster for a field: its data alone. The grid
+    # coordinates are numpy arrays shared with the store, and computing the
+    # DataArray would send them along and bring back a private copy per
+    # field, which the render cache would hold but not count.
+    if isinstance(collection, xr.DataArray):
+        return collection.variable
+    return collection
+
+
+def _with_coords(collection, result):
+    # The computed data back on the field's shared coordinates
+    if isinstance(collection, xr.DataArray):
+        return collection.copy(deep=False, data=result.data)
+    return result
+
+
+def compute_fields(*collections):
+    # dask.compute of fields for callers without a RenderScheduler
+    results = dask.compute(*[_data(collection) for collection in collections])
+    return [_with_coords(collection, result) for collection, result in zip(collections, results)]
+
+
+class RenderScheduler:
+    # Tracks the in-flight dask work of one session. Every new (time, depth)
+    # request starts a new generation and cancels the futures of older ones,
+    # so superseded renders do not keep running on the cluster.
+    def __init__(self, client):
+        self.generation = 0
+        self._client = client
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def begin(self):
+        with self._lock:
+            self.generation += 1
+            stale, self._futures = self._futures, set()
+        if stale:
+            self._client.cancel(list(stale))
+        return self.generation
+
+    def is_current(self, generation):
+        return generation == self.generation
+
+    def run(self, generation, func, *args):
+        # Call a builder on behalf of `generation`; None if it was superseded
+        self._local.generation = generation
+        try:
+            return func(*args)
+        except CancelledError:
+            return None
+        finally:
+            self._local.generation = None
+
+    def compute(self, *collections):
+        generation = getattr(self._local, 'generation', None)
+        with self._lock:
+            if generation is not None and not self.is_current(generation):
+                raise CancelledError()
+            futures = self._client.compute([_data(collection) for collection in collections])
+            # fields of a memory-mapped store come back as they are
+            pending = [future for future in futures if isinstance(future, Future)]
+            self._futures.update(pending)
+        try:
+            results = self._client.gather(futures)
+            return [_with_coords(collection, result) for collection, result in zip(collections, results)]
+        finally:
+            with self._lock:
+                self._futures.difference_update(pending)
+
+
+PREFETCH_CONCURRENCY = int(os.environ.get('COAWST_PREFETCH_CONCURRENCY', 2))
+PREFETCH_HOURS = int(os.environ.get('COAWST_PREFETCH_HOURS', 1))
+PREFETCH_PRIORITY = -10 # below the default 0 of user-initiated renders
+
+
+class Prefetcher:
+    # Warms the render cache with fields the user is likely to ask for next.
+    # Only `max_inflight` prefetches run at once, they are scheduled below
+    # user work on the cluster, and nothing new is started while any
+    # session has a render in flight.
+    def __init__(self, cache, client, max_inflight=PREFETCH_CONCURRENCY):
+        self.max_inflight = max_inflight
+        self.issued = 0
+        self._cache = cache
+        self._client = client
+        self._pending = OrderedDict()
+        self._inflight = {}
+        self._renders = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def user_render(self):
+        with self._lock:
+            self._renders += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._renders -= 1
+            self._pump()
+
+    def prefetch(self, fields):
+        # `fields` maps cache keys to lazy fields; replaces whatever was
+        # still waiting from an earlier view
+        with self._lock:
+            self._pending = OrderedDict(
+                (key, field) for key, field in fields.items()
+                if key not in self._cache and key not in self._inflight
+                # memory-mapped fields are no cheaper to read ahead
+                and is_dask_collection(field)
+            )
+        self._pump()
+
+    def stats(self):
+        used, wasted = self._cache.prefetch_used, self._cache.prefetch_wasted
+        return dict(
+            issued=self.issued,
+            pending=len(self._pending),
+            inflight=len(self._inflight),
+            used=used,
+            wasted=wasted,
+            hit_rate=used/self.issued if self.issued else 0.0,
+        )
+
+    def _pump(self):
+        with self._lock:
+            while self._pending and not self._renders and len(self._inflight) < self.max_inflight:
+                key, field = self._pending.popitem(last=False)
+                future = self._client.compute(_data(field), priority=PREFETCH_PRIORITY)
+                self._inflight[key] = future
+                self.issued += 1
+                future.add_done_callback(partial(self._done, key, field))
+
+    def _done(self, key, field, future):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if future.status == 'finished' and key not in self._cache:
+            self._cache.put(key, _with_coords(field, future.result()), prefetched=True)
+        self._pump()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+# spatial.py
+import threading
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS = 6371.0 #km
+
+
+def _to_xyz(lon, lat):
+    lon = np.deg2rad(np.asarray(lon, dtype='f8'))
+    lat = np.deg2rad(np.asarray(lat, dtype='f8'))
+    return np.stack(
+        [np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)],
+        axis=-1,
+    )
+
+
+def _chord(km):
+    # straight-line distance on the unit sphere for an arc of `km`
+    return 2*np.sin(np.asarray(km, dtype='f8')/(2*EARTH_RADIUS))
+
+
+class RhoIndex:
+    # KD-tree over the wet rho points of a curvilinear ROMS grid. Points are
+    # placed on the unit sphere so radii are true distances in km.
+    def __init__(self, lon_rho, lat_rho, mask_rho=None):
+        lon = np.asarray(lon_rho)
+        lat = np.asarray(lat_rho)
+        wet = np.isfinite(lon) & np.isfinite(lat)
+        if mask_rho is not None:
+            wet &= np.asarray(mask_rho) > 0
+        self.shape = lon.shape
+        self._cells = np.flatnonzero(wet)
+        self._tree = cKDTree(_to_xyz(lon.ravel()[self._cells], lat.ravel()[self._cells]))
+
+    def query(self, lon, lat, radius=7, max_distance=None):
+        # (eta, xi) of every wet rho point within `radius` km of lon/lat. If
+        # none is that close, fall back to the nearest one, as long as it is
+        # within `max_distance` km (default 2*radius).
+        if max_distance is None:
+            max_distance = 2*radius
+        xyz = _to_xyz(lon, lat)
+        hits = self._tree.query_ball_point(xyz, _chord(radius))
+        if not hits:
+            dist, hit = self._tree.query(xyz)
+            if dist > _chord(max_distance):
+                return np.array([], dtype=int), np.array([], dtype=int)
+            hits = [hit]
+        return np.unravel_index(self._cells[np.sort(hits)], self.shape)
+
+    def nearest(self, lon, lat, max_distance):
+        # (eta, xi, found) of the wet rho point nearest to each of many
+        # lon/lat points in one query; points with none within
+        # `max_distance` km are not found and get index 0
+        dist, hit = self._tree.query(_to_xyz(lon, lat), distance_upper_bound=_chord(max_distance))
+        found = np.isfinite(dist)
+        eta, xi = np.unravel_index(self._cells[np.where(found, hit, 0)], self.shape)
+        return eta, xi, found
+
+
+ARROWS_ACROSS = 30 # vector arrows across the viewport
+
+
+class ArrowSampler:
+    # Picks at most one wet rho point per cell of a lattice in display
+    # coordinates. Zoom level z halves the lattice spacing z times, so with
+    # the level matched to the viewport about ARROWS_ACROSS arrows span it
+    # at any zoom. The lattice is aligned to the grid, not the viewport, so
+    # a level's selection does not change while panning.
+    def __init__(self, x, y, mask=None, across=ARROWS_ACROSS):
+        x = np.asarray(x, dtype='f8')
+        y = np.asarray(y, dtype='f8')
+        wet = np.isfinite(x) & np.isfinite(y)
+        if mask is not None:
+            wet &= np.asarray(mask) > 0
+        self.shape = x.shape
+        self.across = across
+        self._cells = np.flatnonzero(wet)
+        points = np.column_stack([x.ravel()[self._cells], y.ravel()[self._cells]])
+        self._tree = cKDTree(points)
+        self._x0, self._y0 = points.min(axis=0)
+        self._x1, self._y1 = points.max(axis=0)
+        self.width = self._x1-self._x0
+        spacing = np.median(self._tree.query(points, k=2)[0][:,1])
+        # past this level the lattice is finer than the grid itself
+        self.max_zoom = max(0, int(np.ceil(np.log2(self.width/(across*spacing)))))
+        self._zooms = {}
+        self._lock = threading.Lock()
+
+    def zoom(self, x_range=None):
+        if x_range is None or x_range[1] <= x_range[0]:
+            return 0
+        zoom = np.round(np.log2(self.width/(x_range[1]-x_range[0])))
+        return int(np.clip(zoom, 0, self.max_zoom))
+
+    def sample(self, zoom):
+        # (eta, xi) of the wet rho point nearest to each lattice node
+        with self._lock:
+            if zoom not in self._zooms:
+                step = self.width/(2**zoom*self.across)
+                gx, gy = np.meshgrid(
+                    np.arange(self._x0+step/2, self._x1, step),
+                    np.arange(self._y0+step/2, self._y1, step),
+                )
+                dist, idx = self._tree.query(
+                    np.column_stack([gx.ravel(), gy.ravel()]),
+                    distance_upper_bound=step/2,
+                )
+                cells = np.unique(self._cells[idx[np.isfinite(dist)]])
+                self._zooms[zoom] = np.unravel_index(cells, self.shape)
+            return self._zooms[zoom]
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# coding: utf-8
+# store.py
+import os
+import threading
+from functools import partial
+
+import xarray as xr
+
+from codec import COMPACT_FIELDS, decode, encode_dataset, encode_like
+from derived import CURRENT_FIELDS, add_current_fields
+from ingest import CATALOG_URL, LAYOUTS, STORE_PATH, open_source, open_store, subset
+from metrics import span
+from precompute import open_serving
+from projection import mercator_grid
+from pyramid import PYRAMID_FACTORS, coarsen_masked
+from scheduler import compute_fields
+from vertical import VerticalGrid, has_vertical_grid, select_depth, z_depth
+
+
+GRID_COORDS = ['lon_rho','lat_rho','mask_rho','h','Cs_r']
+# seconds between checks for a cycle swapped in by ingest.py, which only
+# keeps KEEP_CYCLES cycles on disk; 0 disables
+REFRESH_INTERVAL = int(os.environ.get('COAWST_REFRESH_INTERVAL', 60))
+SHARE_DATASET = os.environ.get('COAWST_SHARE_DATASET', '1') == '1'
+DATASET_NAME = 'coawst'
+
+
+def _load_grid(ds):
+    # Grid coordinates are read, and projected to Web Mercator, once and
+    # shared by every slice as numpy (precomputed stores already are)
+    if 'x_rho' in ds.coords:
+        return ds
+    ds = ds.assign_coords({
+        name: (ds[name].dims, ds[name].values)
+        for name in GRID_COORDS if name in ds.coords
+    })
+    x, y = mercator_grid(ds.lon_rho.values, ds.lat_rho.values)
+    return ds.assign_coords(
+        x_rho=(ds.lon_rho.dims, x),
+        y_rho=(ds.lat_rho.dims, y),
+    )
+
+
+def dataset_name(version):
+    return f'{DATASET_NAME}-{version}'
+
+
+def published_dataset(client, name, ds):
+    # The copy of `ds` persisted on the cluster under `name`. The first
+    # process to ask persists and publishes it, later ones just attach, and
+    # the datasets of older cycles are unpublished so workers can free them.
+    shared = client.get_dataset(name, default=None)
+    if shared is not None:
+        return shared
+    shared = client.persist(ds)
+    try:
+        client.publish_dataset(shared, name=name)
+    except KeyError:
+        # another process published it first
+        return client.get_dataset(name)
+    for old in client.list_datasets():
+        if isinstance(old, str) and old.startswith(f'{DATASET_NAME}-') and old != name:
+            client.unpublish_dataset(old)
+    return shared
+
+
+def _with_derived(ds):
+    ds = _load_grid(ds)
+    if all(name in ds.data_vars for name in CURRENT_FIELDS):
+        return ds
+    return add_current_fields(ds)
+
+
+class ForecastStore:
+    # The served forecast window in two physical layouts. Map panels read one
+    # time step over the whole grid from `map`; point timeseries read a few
+    # cells over every time step from `series`. Without a local mirror both
+    # point at the same (remote) dataset. `pyramid` holds the coarsened map
+    # levels by coarsening factor, where they were precomputed, and `summary`
+    # the per-tile min/max summaries of each level. `version` names the
+    # forecast cycle by its last time step and `path` is the cycle directory
+    # it was opened from, if any. With COMPACT_FIELDS the map and
+    # pyramid fields are uint16 codes (see codec.py), so what is persisted
+    # on the cluster and held in the render cache takes half the memory.
+    def __init__(self, map_ds, series_ds=None, pyramid=None, summary=None):
+        self.map = _with_derived(map_ds)
+        if COMPACT_FIELDS:
+            self.map = encode_dataset(self.map)
+        self.shared = False
+        self.path = None
+        self._lock = threading.Lock()
+        self.version = self.map.ocean_time.values.astype(str)[-1]
+        self.series = self.map if series_ds is None else _with_derived(series_ds)
+        self.pyramid = {
+            factor: _load_grid(level) for factor, level in (pyramid or {}).items()
+        }
+        if COMPACT_FIELDS:
+            self.pyramid = {factor: encode_dataset(level) for factor, level in self.pyramid.items()}
+        self.summary = {
+            factor: summary.load() for factor, summary in (summary or {}).items()
+        }
+
+    def share(self, client):
+        # Serve `map` from the working set persisted once on the cluster for
+        # this cycle, so app processes do not each hold their own copy
+        with self._lock:
+            if not self.shared and self.map.chunks:
+                shared = published_dataset(client, dataset_name(self.version), self.map)
+                if self.series is self.map:
+                    self.series = shared
+                self.map = shared
+            # memory-mapped stores are already shared through the page cache
+            self.shared = True
+        return self
+
+    def serving_groups(self):
+        # What precompute.py writes for this store
+        return {'map': self.map, **{
+            f'pyramid/{factor}': level for factor, level in self.pyramid.items()
+        }}
+
+    @classmethod
+    def open(cls, path, serving=True):
+        if not os.path.exists(path):
+            return cls(subset(open_source(CATALOG_URL)))
+        # pin the forecast cycle the store link points at right now
+        path = os.path.realpath(path)
+        summary = {
+            factor: open_store(path, f'summary/{factor}') for factor in PYRAMID_FACTORS
+            if os.path.exists(os.path.join(path, 'summary', str(factor)))
+        }
+        groups = open_serving(path) if serving else None
+        if groups is not None:
+            # precomputed: the map doubles as the timeseries layout
+            pyramid = {
+                int(group.split('/')[1]): level for group, level in groups.items()
+                if group.startswith('pyramid/')
+            }
+            store = cls(groups['map'], None, pyramid, summary)
+            store.path = path
+            return store
+        groups = {
+            group: open_store(path, group) for group in LAYOUTS
+            if os.path.exists(os.path.join(path, group))
+        }
+        if 'map' not in groups:
+            groups['map'] = open_store(path)
+        pyramid = {
+            factor: open_store(path, f'pyramid/{factor}') for factor in PYRAMID_FACTORS
+            if os.path.exists(os.path.join(path, 'pyramid', str(factor)))
+        }
+        store = cls(groups['map'], groups.get('series'), pyramid, summary)
+        store.path = path
+        return store
+
+
+class FieldSource:
+    # Fields, pyramid levels and z-depth weights of a ForecastStore, read
+    # through the process-wide render cache under the keys every user of
+    # that cache shares (viewer sessions and the tile endpoint). `compute`
+    # runs the missing fields, e.g. a session's RenderScheduler.compute.
+    def __init__(self, store, cache, compute=compute_fields):
+        self.store = store
+        self.cache = cache
+        self.compute = compute
+        self.version = store.version
+        self.vertical = VerticalGrid(store.map) if has_vertical_grid(store.map) else None
+
+    def key(self, name, time, depth, *extra):
+        # Cache key for a field or an artifact derived from it (`extra`);
+        # the dataset version always comes last
+        if 's_rho' not in self.store.map[name].dims:
+            depth = None
+        if time is not None:
+            time = int(time)
+        return (name, time, depth, *extra, self.version)
+
+    def z_slice(self, name, depth):
+        # Whether `name` at `depth` is interpolated to a metre depth rather
+        # than read at a sigma level
+        return 's_rho' in self.store.map[name].dims and z_depth(depth) is not None
+
+    def select(self, name, time, depth, ds=None):
+        # The lazy field, from `map` or another dataset of the same layout
+        if ds is None:
+            ds = self.store.map
+        da = ds[name].isel(ocean_time=int(time))
+        weights = self.z_weights(time, depth) if self.z_slice(name, depth) else None
+        return select_depth(da, depth, weights)
+
+    def cached(self, stage, key, func):
+        # The render cache's get_or_compute, timed as `stage` and tagged
+        # with whether it had to compute
+        with span(stage, key[0], key[2], cache='hit') as tags:
+            value = self.cache.get(key)
+            if value is None:
+                tags['cache'] = 'miss'
+                value = self.cache.put(key, func())
+            return value
+
+    def z_weights(self, time, depth):
+        # Interpolation weights onto a metre depth depend only on the grid
+        # and the free surface, so they are computed once per time step and
+        # depth and shared; every field at that depth is then a weighted sum
+        key = ('z_weights', int(time), depth, self.version)
+        return self.cached('z_weights', key, partial(self._load_z_weights, time, depth))
+
+    def _load_z_weights(self, time, depth):
+        zeta = decode(self.fields(['zeta'], time, None)['zeta'])
+        return self.vertical.weights(zeta, z_depth(depth))
+
+    def fields(self, names, time, depth):
+        # Reduced numpy fields at one time and depth, computed together
+        with span('fields', '+'.join(names), depth, cache='hit') as tags:
+            fields, missing = {}, {}
+            for name in names:
+                key = self.key(name, time, depth)
+                field = self.cache.get(key)
+                if field is None:
+                    missing[key] = self.select(name, time, depth)
+                else:
+                    fields[name] = field
+            if missing:
+                tags['cache'] = 'miss'
+            for key, field in zip(missing, self.compute(*missing.values())):
+                fields[key[0]] = self.cache.put(key, field)
+            return xr.Dataset({name: fields[name] for name in names})
+
+    def level(self, name, time, depth, factor):
+        # A field coarsened by `factor`: the stored pyramid level where there
+        # is one, else coarsened here from the full field
+        if factor == 1:
+            return self.fields([name], time, depth)[name]
+        key = self.key(name, time, depth, factor)
+        return self.cached('level', key, partial(self._load_level, name, time, depth, factor))
+
+    def _load_level(self, name, time, depth, factor):
+        pyramid = self.store.pyramid
+        if factor in pyramid and name in pyramid[factor] and not self.z_slice(name, depth):
+            level, = self.compute(self.select(name, time, depth, pyramid[factor]))
+            return level
+        field = self.level(name, time, depth, 1)
+        return encode_like(coarsen_masked(decode(field), factor), field)
+
+
+_served = {}
+_served_lock = threading.Lock()
+
+
+def shared_store(path=STORE_PATH):
+    # One open store per server process, used by the viewer sessions and the
+    # tile endpoint alike
+    with _served_lock:
+        if path not in _served:
+            _served[path] = ForecastStore.open(path)
+        return _served[path]
+
+
+def set_shared_store(store, path=STORE_PATH):
+    # Serve `store` from now on; sessions pick it up on their next render
+    with _served_lock:
+        _served[path] = store
+
+
+def refresh_store(path=STORE_PATH):
+    # Adopt the cycle the store link points at once the single writer
+    # (`python ingest.py --update`, e.g. from cron) has swapped in a new
+    # one. Every server process runs this; none of them ingests. Sessions
+    # keep the store they hold, which stays readable, until they pick up
+    # the new one on their next render.
+    if not os.path.exists(path):
+        return None
+    cycle = os.path.realpath(path)
+    if shared_store(path).path == cycle:
+        return None
+    store = ForecastStore.open(cycle)
+    set_shared_store(store, path)
+    return store.version
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding: utf-8
+# synthetic.py
+import argparse
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array as da
+
+USEAST_SHAPE = (336, 896) # eta_rho, xi_rho of the COAWST-USEAST grid
+N_LEVELS = 16
+N_TIMES = 72
+START = '2024-01-01'
+THETA_S = 5.0 # surface stretching of the synthetic sigma levels
+HC = 20.0 #m
+
+
+def make_grid(shape=USEAST_SHAPE):
+    # A rotated, slightly bent grid over the Gulf of Mexico with land along
+    # its western and northern edges
+    ne, nx = shape
+    eta, xi = np.meshgrid(np.linspace(0, 1, ne), np.linspace(0, 1, nx), indexing='ij')
+    lon = -98 + 22*xi - 2*eta + 0.5*np.sin(np.pi*eta)
+    lat = 18 + 12*eta + 1.5*xi + 0.3*np.sin(np.pi*xi)
+    coast = 0.08 + 0.05*np.sin(6*np.pi*eta)
+    mask = ((xi > coast) & (eta < 0.92 - 0.04*np.cos(5*np.pi*xi))).astype('f8')
+    return lon, lat, mask
+
+
+def _smooth(shape, seed, waves=4):
+    # Sum of a few random plane waves, values roughly in [-1, 1]
+    ne, nx = shape
+    rng = np.random.default_rng(seed)
+    eta, xi = np.meshgrid(np.linspace(0, 1, ne), np.linspace(0, 1, nx), indexing='ij')
+    field = np.zeros(shape)
+    for k in rng.uniform(1, 6, size=(waves, 3)):
+        field += np.sin(2*np.pi*(k[0]*eta + k[1]*xi) + k[2])
+    return field/waves
+
+
+def _lazy(base, n_times, n_levels, seed, scale, noise):
+    # base(eta, xi) swinging with a tide and drifting over the window,
+    # weaker with depth when n_levels is set, plus reproducible noise. One
+    # time step (and every level) per chunk, built lazily with dask.
+    t = np.arange(n_times)
+    tide = np.sin(2*np.pi*t/12.42)[:, None, None]
+    drift = (t/max(n_times-1, 1))[:, None, None]
+    field = da.from_array(base, chunks=-1)[None]*(1 + 0.2*tide) + 0.3*drift
+    if n_levels:
+        field = field[:, None]*np.linspace(0.4, 1, n_levels)[None, :, None, None]
+    chunks = (1,) + field.shape[1:]
+    field = field.rechunk(chunks)*scale
+    field = field + noise*da.random.RandomState(seed).standard_normal(field.shape, chunks=chunks)
+    return field.astype('f4')
+
+
+def make_dataset(shape=USEAST_SHAPE, n_times=N_TIMES, n_levels=N_LEVELS, seed=0):
+    # A lazy ROMS-like dataset with the variables, dimensions and staggering
+    # the viewer reads from the COAWST-USEAST archive. Land is NaN in every
+    # field and 0 in mask_rho.
+    ne, nx = shape
+    lon, lat, mask = make_grid(shape)
+    wet = mask > 0
+    s_rho = (np.arange(n_levels) + 0.5)/n_levels - 1
+
+    def rho(offset, scale, noise, seed_, levels=True):
+        dims = ('ocean_time', 's_rho', 'eta_rho', 'xi_rho') if levels else ('ocean_time', 'eta_rho', 'xi_rho')
+        field = _lazy(_smooth(shape, seed+seed_), n_times, n_levels if levels else 0, seed+seed_, scale, noise)
+        return dims, da.where(wet, field + offset, np.nan)
+
+    def face(dims, base_shape, wet_faces, seed_):
+        field = _lazy(_smooth(base_shape, seed+seed_), n_times, n_levels, seed+seed_, 0.6, 0.05)
+        return dims, da.where(wet_faces, field, np.nan)
+
+    # Mean wave direction in degrees, 0..360, like the archive's Dwave (and
+    # the range codec.py holds it in). The viewer turns it into the radians
+    # HoloViews' VectorField takes as its angle when it draws the arrows.
+    dwave_dims, dwave = rho(180, 180, 3, 5, levels=False)
+
+    return xr.Dataset(
+        {
+            'temp': rho(22, 6, 0.05, 1),
+            'salt': rho(35, 1.5, 0.02, 2),
+            'zeta': rho(0, 0.3, 0.01, 3, levels=False),
+            'Hwave': rho(1.2, 0.8, 0.02, 4, levels=False),
+            'Dwave': (dwave_dims, dwave % 360),
+            'evaporation': rho(0, 1e-7, 1e-9, 6, levels=False),
+            'u': face(('ocean_time', 's_rho', 'eta_u', 'xi_u'), (ne, nx-1), wet[:, 1:] & wet[:, :-1], 10),
+            'v': face(('ocean_time', 's_rho', 'eta_v', 'xi_v'), (ne-1, nx), wet[1:] & wet[:-1], 11),
+            'mask_rho': (('eta_rho', 'xi_rho'), mask),
+            'h': (('eta_rho', 'xi_rho'), np.where(wet, 20 + 3000*(1 - _smooth(shape, seed+7)**2), 0)),
+            'Cs_r': ('s_rho', (1 - np.cosh(THETA_S*s_rho))/(np.cosh(THETA_S) - 1)),
+            'hc': HC,
+            'Vtransform': 2,
+        },
+        coords={
+            'ocean_time': pd.date_range(START, periods=n_times, freq='h').values.astype('datetime64[ns]'),
+            's_rho': s_rho,
+            'lon_rho': (('eta_rho', 'xi_rho'), lon),
+            'lat_rho': (('eta_rho', 'xi_rho'), lat),
+        },
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic COAWST-like dataset to a Zarr store (a --source for ingest.py)')
+    parser.add_argument('--out', default='synthetic.zarr')
+    parser.add_argument('--shape', type=int, nargs=2, default=USEAST_SHAPE, metavar=('ETA', 'XI'))
+    parser.add_argument('--times', type=int, default=N_TIMES)
+    parser.add_argument('--levels', type=int, default=N_LEVELS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    make_dataset(tuple(args.shape), args.times, args.levels, args.seed).to_zarr(args.out, mode='w')
+    print(args.out)
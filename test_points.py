@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# coding: utf-8
+# test_points.py
+import json
+
+import tornado.web
+from tornado.testing import AsyncHTTPTestCase
+
+import points
+from ingest import subset
+from store import ForecastStore, set_shared_store
+from synthetic import make_dataset
+
+
+class PointsHandlerTest(AsyncHTTPTestCase):
+    # Requests the handler must turn away with a 400 before any extraction
+    @classmethod
+    def setUpClass(cls):
+        set_shared_store(ForecastStore(subset(make_dataset((42,112), 2), window=2)))
+
+    def get_app(self):
+        return tornado.web.Application(points.ROUTES)
+
+    def get(self, query):
+        return self.fetch(f'{points.POINTS_ROOT}?{query}')
+
+    def post(self, body):
+        return self.fetch(points.POINTS_ROOT, method='POST', body=json.dumps(body))
+
+    def test_get_nan_point(self):
+        self.assertEqual(self.get('points=nan,nan').code, 400)
+
+    def test_get_inf_point(self):
+        self.assertEqual(self.get('points=-90,24;inf,24').code, 400)
+
+    def test_post_nan_point(self):
+        self.assertEqual(self.post({'points': [[float('nan'), 0]]}).code, 400)
+
+    def test_post_variables_not_names(self):
+        self.assertEqual(self.post({'points': [[-90, 24]], 'variables': 5}).code, 400)
+        self.assertEqual(self.post({'points': [[-90, 24]], 'variables': ['temp', 5]}).code, 400)
+
+    def test_post_valid(self):
+        response = self.post({'points': [[-90, 24]], 'variables': ['temp']})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(json.loads(response.body)['points']), 1)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding: utf-8
+# tiles.py
+import io
+import os
+import hashlib
+from functools import partial
+
+import numpy as np
+import datashader
+import datashader.transfer_functions as tf
+import panel as pn
+import tornado.web
+from holoviews.plotting.util import process_cmap
+from PIL import Image
+from tornado.ioloop import IOLoop
+
+from cache import RenderCache
+from codec import decode
+from metrics import register_stats
+from pyramid import choose_factor, viewport_clim
+from store import FieldSource, shared_store
+from vertical import depth_choices, select_depth
+
+TILE_SIZE = 256 #pixels
+TILE_ROOT = os.environ.get('COAWST_TILE_ROOT', '/tiles')
+TILE_LAYERS = os.environ.get('COAWST_TILE_LAYERS', '0') == '1'
+# a tile URL names its forecast cycle, so its image never changes
+TILE_MAX_AGE = int(os.environ.get('COAWST_TILE_MAX_AGE', 7*24*3600)) #seconds
+TILE_CMAPS = {
+    'salt': 'pink_r',
+    'Hwave': 'cool',
+    'mag': 'cet_linear_wcmr_100_45_c42',
+    'temp': 'Plasma',
+}
+WORLD = 20037508.342789244 # half the width of the Web Mercator square
+
+
+def tile_version(version):
+    # URL-safe name of a forecast cycle, as in its directory name
+    return np.datetime_as_string(np.datetime64(version), unit='s').replace(':', '')
+
+
+def tile_url(name, time, depth, version):
+    # XYZ template for gv.WMTS. `time` indexes the rolling window of the
+    # cycle `version`, so the cycle is part of the URL.
+    return f'{TILE_ROOT}/{tile_version(version)}/{name}/{int(time)}/{depth}/{{Z}}/{{X}}/{{Y}}.png'
+
+
+def tile_bounds(z, x, y):
+    # Web Mercator (x0, y0, x1, y1) of an XYZ tile, rows counted from the top
+    size = 2*WORLD/2**z
+    return (-WORLD+x*size, WORLD-(y+1)*size, -WORLD+(x+1)*size, WORLD-y*size)
+
+
+def _png(img):
+    buf = io.BytesIO()
+    img.save(buf, format='png')
+    return buf.getvalue()
+
+
+class TileSource:
+    # Renders XYZ tiles of the map fields from a ForecastStore. Fields and
+    # pyramid levels come from a FieldSource on the process-wide render
+    # cache, shared with the viewer sessions, and so do the finished PNGs.
+    # Every tile of one field, time and depth is shaded over the same range
+    # so they join up, and tiles are named by the forecast cycle for HTTP
+    # caching.
+    def __init__(self, store, cache):
+        self.store = store
+        self.cache = cache
+        self.version = store.version
+        self.url_version = tile_version(store.version)
+        x, y = store.map.x_rho.values, store.map.y_rho.values
+        self.extent = (np.nanmin(x), np.nanmin(y), np.nanmax(x), np.nanmax(y))
+        self.cell_size = (self.extent[2]-self.extent[0])/store.map.sizes['xi_rho']
+        self.times = store.map.sizes['ocean_time']
+        self.depths = depth_choices(store.map)
+        self.fields = FieldSource(store, cache)
+
+    def span(self, name, time, depth):
+        # Colour range of the whole field, from its tile summaries when the
+        # store has them
+        summary = self.store.summary.get(1)
+        if summary is not None and f'{name}_min' in summary and not self.fields.z_slice(name, depth):
+            summary = select_depth(summary[[f'{name}_min', f'{name}_max']].isel(ocean_time=int(time)), depth)
+            clim = viewport_clim(summary, name)
+            if clim is not None:
+                return clim
+        field = decode(self.fields.level(name, time, depth, 1))
+        return float(field.min()), float(field.max())
+
+    def etag(self, name, time, depth, z, x, y):
+        tag = repr((self.version, name, int(time), depth, z, x, y)).encode()
+        return '"%s"' % hashlib.sha1(tag).hexdigest()
+
+    def tile(self, name, time, depth, z, x, y):
+        key = self.fields.key(name, time, depth, 'tile', z, x, y)
+        return self.cache.get_or_compute(key, partial(self._render, name, time, depth, z, x, y))
+
+    def _render(self, name, time, depth, z, x, y):
+        x0, y0, x1, y1 = tile_bounds(z, x, y)
+        ex0, ey0, ex1, ey1 = self.extent
+        if x1 < ex0 or x0 > ex1 or y1 < ey0 or y0 > ey1:
+            return _png(Image.new('RGBA', (TILE_SIZE, TILE_SIZE)))
+        canvas = datashader.Canvas(
+            plot_width=TILE_SIZE, plot_height=TILE_SIZE,
+            x_range=(x0, x1), y_range=(y0, y1),
+        )
+        factor = choose_factor((x1-x0)/self.cell_size, TILE_SIZE)
+        field = decode(self.fields.level(name, time, depth, factor))
+        agg = canvas.quadmesh(field, x='x_rho', y='y_rho')
+        cmap = process_cmap(TILE_CMAPS[name])
+        img = tf.shade(agg, cmap=cmap, how='linear', span=self.span(name, time, depth))
+        return _png(img.to_pil())
+
+
+def tile_source():
+    # Rebuilt whenever the shared store moves to a new forecast cycle
+    store = shared_store()
+    source = pn.state.cache.get('tile_source')
+    if source is None or source.store is not store:
+        cache = pn.state.as_cached('render_cache', lambda: register_stats('render_cache', RenderCache()))
+        cache.set_version(store.version)
+        source = pn.state.cache['tile_source'] = TileSource(store, cache)
+    return source
+
+
+class TileHandler(tornado.web.RequestHandler):
+    # GET /tiles/{version}/{var}/{time}/{depth}/{z}/{x}/{y}.png
+    # Only the cycle being served has tiles; older ones are 404.
+    _etag = None
+
+    def compute_etag(self):
+        return self._etag
+
+    async def get(self, version, name, time, depth, z, x, y):
+        source = tile_source()
+        time, z, x, y = int(time), int(z), int(x), int(y)
+        if version != source.url_version:
+            raise tornado.web.HTTPError(404)
+        if name not in TILE_CMAPS or depth not in source.depths:
+            raise tornado.web.HTTPError(404)
+        if not 0 <= time < source.times or not (0 <= x < 2**z and 0 <= y < 2**z):
+            raise tornado.web.HTTPError(404)
+        self._etag = source.etag(name, time, depth, z, x, y)
+        self.set_etag_header()
+        self.set_header('Cache-Control', f'public, max-age={TILE_MAX_AGE}, immutable')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        png = await IOLoop.current().run_in_executor(
+            None, source.tile, name, time, depth, z, x, y
+        )
+        self.set_header('Content-Type', 'image/png')
+        self.write(png)
+
+
+# Served next to the viewer with `panel serve app.py --plugins tiles`
+ROUTES = [
+    (TILE_ROOT + r'/([\w-]+)/(\w+)/(\d+)/(\w+)/(\d+)/(\d+)/(\d+)\.png', TileHandler, {}),
+]
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# coding: utf-8
+# vertical.py
+import os
+import re
+
+import numpy as np
+import xarray as xr
+
+from codec import decode, encode_like
+
+SIGMA_DEPTHS = ['Surface', 'Middle', 'Bottom']
+# metres below mean sea level offered when the store has its vertical grid.
+# Fields are interpolated between the sigma levels ingest kept, so keep more
+# of them (ingest.py --levels) for finer slices.
+Z_DEPTHS = [int(z) for z in os.environ.get('COAWST_Z_DEPTHS', '10,50,200').split(',') if z]
+VERTICAL_COORDS = ['h','Cs_r','hc','Vtransform']
+
+
+def has_vertical_grid(ds):
+    return 's_rho' in ds.dims and all(name in ds.variables for name in ('h','Cs_r','hc'))
+
+
+def depth_choices(ds):
+    if not has_vertical_grid(ds):
+        return list(SIGMA_DEPTHS)
+    return SIGMA_DEPTHS + [f'{z}m' for z in Z_DEPTHS]
+
+
+def z_depth(depth):
+    # Metres of a z-depth choice such as '50m'; None for the sigma choices
+    match = re.fullmatch(r'(\d+)m', depth or '')
+    return None if match is None else float(match.group(1))
+
+
+def sigma_index(da, depth):
+    # Position among the kept levels of a sigma choice: the top and bottom
+    # ones, and the one nearest mid-column
+    if depth == 'Surface':
+        return -1
+    if depth == 'Bottom':
+        return 0
+    return int(np.argmin(np.abs(da.s_rho.values + 0.5)))
+
+
+class VerticalGrid:
+    # ROMS vertical coordinate (Vtransform 1 or 2) of the levels a store
+    # keeps, and linear interpolation weights from those levels onto a
+    # fixed depth for a given free surface
+    def __init__(self, ds):
+        self.h = ds.h.reset_coords(drop=True)
+        self.vtransform = int(ds.Vtransform) if 'Vtransform' in ds.variables else 2
+        s = ds.s_rho.reset_coords(drop=True)
+        cs = ds.Cs_r.reset_coords(drop=True)
+        hc = float(ds.hc)
+        if self.vtransform == 2:
+            self.stretch = (hc*s + self.h*cs)/(hc + self.h)
+        else:
+            self.stretch = hc*s + (self.h - hc)*cs
+        self.s_rho = ds.s_rho.values
+        wet = self.h > 0
+        if 'mask_rho' in ds.coords:
+            wet &= ds.mask_rho.reset_coords(drop=True) > 0
+        self.wet = wet
+
+    def z_rho(self, zeta, cells=None):
+        # Height of every rho level for the free surface `zeta`, which may
+        # be one snapshot, every time step, or only the cells selected by
+        # `cells` (eta_rho/xi_rho indexers)
+        h, stretch = self.h, self.stretch
+        if cells is not None:
+            h, stretch = h.isel(**cells), stretch.isel(**cells)
+        zeta = zeta.reset_coords(drop=True)
+        if self.vtransform == 2:
+            z = zeta + (zeta + h)*stretch
+        else:
+            z = stretch + zeta*(1 + stretch/h)
+        return z.assign_coords(s_rho=self.s_rho)
+
+    def weights(self, zeta, depth, cells=None):
+        # Weight of each level at `depth` metres below mean sea level: the
+        # two levels around it share the weight linearly, the top or bottom
+        # level takes it all above or below the kept levels, and columns
+        # shallower than `depth` (or on land) get none and are not valid
+        z = self.z_rho(zeta, cells)
+        target = -depth
+        n = z.sizes['s_rho']
+        level = xr.DataArray(np.arange(n), dims='s_rho', coords={'s_rho': self.s_rho})
+        lower = z.shift(s_rho=1)
+        upper = z.shift(s_rho=-1)
+        rise = ((target - lower)/(z - lower)).where((target >= lower) & (target <= z), 0)
+        fall = ((upper - target)/(upper - z)).where((target > z) & (target < upper), 0)
+        above = (level == n-1) & (target > z.isel(s_rho=-1))
+        below = (level == 0) & (target < z.isel(s_rho=0))
+        h, wet = self.h, self.wet
+        if cells is not None:
+            h, wet = h.isel(**cells), wet.isel(**cells)
+        valid = wet & (target >= -h)
+        weight = (rise + fall + above + below).where(valid, 0).astype('f4')
+        return xr.Dataset({'weight': weight, 'valid': valid})
+
+
+def select_depth(da, depth, weights=None):
+    # `da` at one depth choice: a kept sigma level, or for a z-depth the
+    # weighted sum over levels with `weights` from VerticalGrid.weights.
+    # For weights already in memory only the levels they use are read.
+    if 's_rho' not in da.dims:
+        return da
+    if z_depth(depth) is None:
+        return da.isel(s_rho=sigma_index(da, depth))
+    weight = weights.weight
+    levels = slice(None)
+    if weight.chunks is None:
+        levels = np.flatnonzero((weight > 0).any([dim for dim in weight.dims if dim != 's_rho']).values)
+    field = decode(da).isel(s_rho=levels)
+    values = (field.fillna(0)*weight.isel(s_rho=levels)).sum('s_rho').where(weights.valid)
+    return encode_like(values.rename(da.name), da)